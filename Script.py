@@ -94,6 +94,8 @@ Tᴏᴛᴀʟ Fɪʟᴇs Fʀᴏᴍ Bᴏᴛʜ DBs: <code>{}</code>
 ★ Fʀᴇᴇ Sᴛᴏʀᴀɢᴇ: <code>{} MB</code>
 </b>"""
 
+    PARTIAL_RESULTS_TXT = "\n\n<i>⚠️ Some results could not be fetched in time, more results may exist. Try again in a minute.</i>"
+
     
     LOG_TEXT_G = """#NewGroup
 Kuttu Bot 2 DB💫
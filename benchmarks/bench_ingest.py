@@ -0,0 +1,433 @@
+"""
+Replay a stream of pyrogram Messages through the indexing path and measure it, without
+Telegram. The stream is synthetic (a mix of media, text and deleted messages, some files
+posted twice) or recorded with --record and replayed with --replay.
+
+    python benchmarks/bench_ingest.py [--messages 20000] [--media 0.3] [--deleted 0.1] [--reposts 0.05]
+                                      [--mode index|single] [--session bot|user [--history]]
+                                      [--uri mongodb://localhost:27017]
+                                      [--db-latency-ms 1] [--tg-latency-ms 0] [--no-bloom]
+                                      [--record stream.jsonl | --replay stream.jsonl]
+
+--mode index runs plugins.index.index_files_to_db (fetch/parse/write pipeline, save_files),
+--mode single calls save_file once per media like the live channel handler used to.
+--session user indexes through a stub user session (userbot.client, picked by index_client)
+that answers search_messages, or get_chat_history with --history, instead of get_messages.
+Without --uri the dbs are an in-memory stand-in that waits --db-latency-ms per round trip,
+--mode single needs a real MongoDB because save_file writes through umongo. With --uri a
+throwaway database is created on that server and dropped afterwards.
+
+Reports messages/s, files/s, db round trips per file and peak python memory (tracemalloc,
+measured in a second run over the same stream).
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+import types as _types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHAT_ID = -1001234567890
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--media', type=float, default=0.3, help='share of messages with a video/document/audio')
+    parser.add_argument('--deleted', type=float, default=0.1, help='share of deleted message ids, the rest is text')
+    parser.add_argument('--reposts', type=float, default=0.05, help='share of media that reposts an earlier file')
+    parser.add_argument('--mode', choices=('index', 'single'), default='index')
+    parser.add_argument('--session', choices=('bot', 'user'), default='bot', help='index through the bot or a user session')
+    parser.add_argument('--history', action='store_true', help='user session: read the whole history instead of media searches')
+    parser.add_argument('--uri', help='MongoDB to run against instead of the in-memory stand-in')
+    parser.add_argument('--db-latency-ms', type=float, default=1.0, help='round trip time of the in-memory stand-in')
+    parser.add_argument('--tg-latency-ms', type=float, default=0.0, help='time every get_messages call takes')
+    parser.add_argument('--no-bloom', action='store_true', help='run without the known files bloom filter')
+    parser.add_argument('--record', help='write the synthetic stream to this file')
+    parser.add_argument('--replay', help='replay a recorded stream instead of a synthetic one')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+args = parse_args()
+if args.uri:
+    # a database of its own on the given server, both shards in it
+    os.environ['DATABASE_URI'] = os.environ['SECONDDB_URI'] = args.uri
+    os.environ['DATABASE_NAME'] = f'bench_ingest_{os.getpid()}'
+else:
+    # the clients are created lazily, they only need a parsable uri
+    os.environ.setdefault('DATABASE_URI', 'mongodb://localhost:27017')
+    os.environ.setdefault('SECONDDB_URI', os.environ['DATABASE_URI'])
+
+from pymongo import monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pyrogram import enums, types
+from pyrogram.file_id import FileId, FileType
+from pyrogram.types.messages_and_media.message import Str
+
+
+class RoundTrips(monitoring.CommandListener):
+    """Counts the commands sent to a real MongoDB."""
+    count = 0
+
+    def started(self, event):
+        RoundTrips.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# has to be registered before the first client is created
+monitoring.register(RoundTrips())
+
+import indexer
+import userbot
+import plugins.index as index_plugin
+import database.ia_filterdb as ia
+import database.index_state_db as index_state_db
+from utils import temp
+
+
+# ---------------------------------------------------------------------------
+# message stream
+# ---------------------------------------------------------------------------
+
+MEDIA_KINDS = (
+    ('video', FileType.VIDEO, 'video/x-matroska', '.mkv'),
+    ('document', FileType.DOCUMENT, 'application/zip', '.zip'),
+    ('audio', FileType.AUDIO, 'audio/mpeg', '.mp3'),
+)
+
+
+def synthetic_stream(count, media, deleted, reposts, seed):
+    """Descriptions of messages 1..count, dicts so they can be recorded as json lines."""
+    rng = random.Random(seed)
+    files = []
+    stream = []
+    for i in range(1, count + 1):
+        roll = rng.random()
+        if roll < deleted:
+            stream.append({'id': i, 'kind': 'deleted'})
+        elif roll < deleted + media:
+            if files and rng.random() < reposts:
+                stream.append(dict(rng.choice(files), id=i))
+                continue
+            kind = rng.randrange(len(MEDIA_KINDS))
+            file = {
+                'id': i, 'kind': MEDIA_KINDS[kind][0], 'media_id': 10_000_000 + i,
+                'file_name': f'Some Movie {1990 + i % 35} part {i} 720p{MEDIA_KINDS[kind][3]}',
+                'file_size': rng.randrange(50, 4000) * 1024 * 1024, 'caption': f'Some Movie {i} <b>HDRip</b>',
+            }
+            files.append(file)
+            stream.append(file)
+        else:
+            stream.append({'id': i, 'kind': 'text', 'text': f'message {i}'})
+    return stream
+
+
+def build_message(desc, chat):
+    if desc['kind'] == 'deleted':
+        return types.Message(id=desc['id'], empty=True)
+    if desc['kind'] == 'text':
+        return types.Message(id=desc['id'], chat=chat, text=Str(desc['text']).init([]))
+    kind, file_type, mime_type, _ = next(k for k in MEDIA_KINDS if k[0] == desc['kind'])
+    file_id = FileId(file_type=file_type, dc_id=4, media_id=desc['media_id'], access_hash=desc['media_id'] * 7,
+                     file_reference=b'ref').encode()
+    common = dict(file_id=file_id, file_unique_id=f"AgAD{desc['media_id']}", file_name=desc['file_name'],
+                  mime_type=mime_type, file_size=desc['file_size'])
+    if kind == 'video':
+        media = types.Video(width=1280, height=720, duration=5400, **common)
+    elif kind == 'audio':
+        media = types.Audio(duration=240, **common)
+    else:
+        media = types.Document(**common)
+    return types.Message(id=desc['id'], chat=chat, media=enums.MessageMediaType(kind), caption=Str(desc['caption']).init([]),
+                         **{kind: media})
+
+
+class ReplayClient:
+    """Serves the stream like a bot client would: get_messages by id windows, deleted ids as empty messages."""
+
+    def __init__(self, messages, latency):
+        self.messages = {message.id: message for message in messages}
+        self.latency = latency
+        self.me = _types.SimpleNamespace(id=1, is_bot=True)
+        self.calls = 0
+
+    async def get_messages(self, chat_id, ids):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.messages.get(i) or types.Message(id=i, empty=True) for i in ids]
+
+    async def get_chat(self, chat_id):
+        return types.Chat(id=CHAT_ID, type=enums.ChatType.CHANNEL, dc_id=4)
+
+
+class StubUserClient(ReplayClient):
+    """
+    Serves the stream like a user session: get_chat_history and search_messages pages, newest
+    first, deleted ids left out. get_messages calls are counted in `calls` too.
+    """
+
+    FILTERS = {
+        enums.MessagesFilter.VIDEO: enums.MessageMediaType.VIDEO,
+        enums.MessagesFilter.DOCUMENT: enums.MessageMediaType.DOCUMENT,
+        enums.MessagesFilter.AUDIO: enums.MessageMediaType.AUDIO,
+    }
+
+    def __init__(self, messages, latency):
+        super().__init__(messages, latency)
+        self.me = _types.SimpleNamespace(id=2, is_bot=False)
+        self.newest_first = sorted((m for m in self.messages.values() if not m.empty), key=lambda m: m.id, reverse=True)
+
+    async def _page(self, messages, limit):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for message in messages[:limit or None]:
+            yield message
+
+    def get_chat_history(self, chat_id, limit=0, offset=0, offset_id=0, min_id=0, **kwargs):
+        found = [m for m in self.newest_first if (not offset_id or m.id < offset_id) and m.id > min_id]
+        return self._page(found[offset:], limit)
+
+    def search_messages(self, chat_id, query="", offset=0, filter=enums.MessagesFilter.EMPTY, limit=0, **kwargs):
+        media = self.FILTERS.get(filter)
+        found = [m for m in self.newest_first if media is None or m.media == media]
+        return self._page(found[offset:], limit)
+
+
+class ProgressMessage:
+    chat = _types.SimpleNamespace(id=1)
+    id = 1
+
+    async def edit(self, *args, **kwargs):
+        pass
+
+    edit_text = edit
+
+
+# ---------------------------------------------------------------------------
+# in-memory stand-in for the collections the indexing path uses
+# ---------------------------------------------------------------------------
+
+def _matches(doc, filter):
+    for key, cond in filter.items():
+        if key == '$or':
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+        elif isinstance(cond, dict) and '$in' in cond:
+            if doc.get(key) not in cond['$in']:
+                return False
+        elif isinstance(cond, dict) and '$exists' in cond:
+            if (key in doc) != cond['$exists']:
+                return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def __aiter__(self):
+        self.it = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return self.docs[:length]
+
+
+class MemoryCollection:
+    """Just enough of a motor collection for save_files and the index job bookkeeping, every call is a round trip."""
+    round_trips = 0
+
+    def __init__(self, latency, unique=()):
+        self.latency = latency
+        self.unique = unique
+        self.docs = {}
+
+    async def _round_trip(self):
+        MemoryCollection.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, filter=None, projection=None, **kwargs):
+        # find() itself doesn't talk to the db, the first batch does
+        MemoryCollection.round_trips += 1
+        return MemoryCursor([dict(doc) for doc in self.docs.values() if _matches(doc, filter or {})])
+
+    async def find_one(self, filter, projection=None):
+        await self._round_trip()
+        return next((dict(doc) for doc in self.docs.values() if _matches(doc, filter)), None)
+
+    async def count_documents(self, filter, **kwargs):
+        await self._round_trip()
+        return sum(1 for doc in self.docs.values() if _matches(doc, filter))
+
+    def _duplicate(self, doc):
+        if doc['_id'] in self.docs:
+            return True
+        return any(doc.get(field) is not None and any(d.get(field) == doc[field] for d in self.docs.values())
+                   for field in self.unique)
+
+    async def insert_one(self, doc):
+        await self._round_trip()
+        if self._duplicate(doc):
+            raise DuplicateKeyError('duplicate key', 11000)
+        self.docs[doc['_id']] = dict(doc)
+
+    async def insert_many(self, docs, ordered=True):
+        await self._round_trip()
+        errors = []
+        for i, doc in enumerate(docs):
+            if self._duplicate(doc):
+                errors.append({'index': i, 'code': 11000, 'errmsg': 'duplicate key'})
+            else:
+                self.docs[doc['_id']] = dict(doc)
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+    async def update_one(self, filter, update, upsert=False):
+        await self._round_trip()
+        doc = next((doc for doc in self.docs.values() if _matches(doc, filter)), None)
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(filter)
+            self.docs[doc['_id']] = doc
+        doc.update(update.get('$set', {}))
+        for key, value in update.get('$max', {}).items():
+            doc[key] = max(doc.get(key, value), value)
+        for key, value in update.get('$inc', {}).items():
+            doc[key] = doc.get(key, 0) + value
+
+
+def use_memory_db(latency):
+    unique = ('fingerprint', 'file_unique_id')
+    ia.Media = _types.SimpleNamespace(collection=MemoryCollection(latency, unique))
+    ia.Media2 = _types.SimpleNamespace(collection=MemoryCollection(latency, unique))
+    ia.saveMedia = ia.Media
+    ia.generations = MemoryCollection(latency)
+    index_state_db.jobs = MemoryCollection(latency)
+    index_state_db.high_water = MemoryCollection(latency)
+
+
+# ---------------------------------------------------------------------------
+# runs
+# ---------------------------------------------------------------------------
+
+async def reset_db():
+    if args.uri:
+        await ia.db.client.drop_database(ia.db.name)
+        await ia.Media.ensure_indexes()
+        await ia.Media2.ensure_indexes()
+    else:
+        use_memory_db(args.db_latency_ms / 1000)
+    ia.known_files = None if args.no_bloom else ia.BloomFilter(ia.FILE_BLOOM_CAPACITY, ia.FILE_BLOOM_ERROR_RATE)
+    ia.forget_file()
+
+
+def round_trips():
+    return RoundTrips.count if args.uri else MemoryCollection.round_trips
+
+
+async def run_once(stream):
+    await reset_db()
+    chat = types.Chat(id=CHAT_ID, type=enums.ChatType.CHANNEL)
+    messages = [build_message(desc, chat) for desc in stream]
+    client = ReplayClient(messages, args.tg_latency_ms / 1000)
+    # index_client picks the user session when there is one, like with USERBOT_STRING_SESSION set
+    userbot.client = StubUserClient(messages, args.tg_latency_ms / 1000) if args.session == 'user' else None
+    index_plugin.INDEX_MEDIA_ONLY = not args.history
+    last_id = max(desc['id'] for desc in stream)
+    # pacing is not what is measured here
+    indexer.budget.rate = 0
+    indexer.THROTTLES[('chat', None, CHAT_ID)] = indexer.Throttle(chunk=indexer.Throttle.MAX_CHUNK, delay=0)
+    indexer.THROTTLES[('dc', None, 4)] = indexer.Throttle(chunk=indexer.Throttle.MAX_CHUNK, delay=0)
+    indexer.THROTTLES[('chat', 'user', CHAT_ID)] = indexer.Throttle(chunk=indexer.Throttle.MAX_CHUNK, delay=0)
+    indexer.THROTTLES[('dc', 'user', 4)] = indexer.Throttle(chunk=indexer.Throttle.MAX_CHUNK, delay=0)
+    temp.CURRENT = 1
+
+    trips = round_trips()
+    start = time.perf_counter()
+    if args.mode == 'index':
+        await index_plugin.index_files_to_db(last_id, CHAT_ID, ProgressMessage(), client)
+    else:
+        stats = indexer.IndexStats()
+        for message in messages:
+            media = indexer.extract_media(message, stats)
+            if media:
+                await ia.save_file(media)
+    elapsed = time.perf_counter() - start
+    return elapsed, round_trips() - trips, (userbot.client or client).calls
+
+
+async def saved_files():
+    if args.uri:
+        return await ia.Media.collection.count_documents({})
+    return len(ia.Media.collection.docs) + len(ia.Media2.collection.docs)
+
+
+async def main():
+    if args.replay:
+        with open(args.replay) as f:
+            stream = [json.loads(line) for line in f if line.strip()]
+    else:
+        stream = synthetic_stream(args.messages, args.media, args.deleted, args.reposts, args.seed)
+    if args.record:
+        with open(args.record, 'w') as f:
+            f.writelines(json.dumps(desc) + '\n' for desc in stream)
+    if args.mode == 'single' and not args.uri:
+        sys.exit('--mode single needs --uri, save_file writes through umongo')
+
+    media = sum(1 for desc in stream if desc['kind'] not in ('text', 'deleted'))
+    try:
+        elapsed, trips, calls = await run_once(stream)
+        files = await saved_files()
+        tracemalloc.start()
+        await run_once(stream)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if args.uri:
+            await ia.db.client.drop_database(ia.db.name)
+
+    db = args.uri and re.sub(r'//[^@/]*@', '//', args.uri) or f'in-memory, {args.db_latency_ms}ms round trips'
+    session = 'bot' if args.session == 'bot' else f"user ({'history' if args.history else 'media search'})"
+    print(f"{len(stream)} messages ({media} with media, {files} distinct files saved), mode {args.mode}, session {session}, "
+          f"db {db}, bloom {'off' if args.no_bloom else 'on'}")
+    print(f"{'messages/s':<22}{len(stream) / elapsed:>12.0f}")
+    print(f"{'files/s':<22}{files / elapsed:>12.0f}")
+    print(f"{'db round trips/file':<22}{trips / max(files, 1):>12.2f}")
+    print(f"{'telegram requests':<22}{calls:>12}")
+    print(f"{'peak python memory':<22}{peak / (1024 * 1024):>9.1f} MB")
+    print(f"{'wall time':<22}{elapsed:>11.2f}s")
+
+
+if __name__ == '__main__':
+    # the motor clients are bound to the loop that was current at import time, like in bot.py
+    asyncio.get_event_loop().run_until_complete(main())
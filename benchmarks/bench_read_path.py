@@ -0,0 +1,82 @@
+"""
+Compare the per-page cost of turning search results into objects the plugins can render:
+umongo Media documents built from full documents (the old path) against FileRecords built
+from projected documents (the raw read path). No database is needed.
+
+    python benchmarks/bench_read_path.py [pages] [page_size]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the clients are created lazily, they only need a parsable uri
+os.environ.setdefault('DATABASE_URI', 'mongodb://localhost:27017')
+
+from database.ia_filterdb import Media, FileRecord, FILE_PROJECTION
+
+
+def make_docs(count):
+    return [
+        {
+            '_id': f'BQADBAADfake{i:08d}AAQ',
+            'file_ref': f'AQADBAADfakeref{i:08d}',
+            'file_name': f'Some Movie {2000 + i % 24} 720p HDRip x264 part {i}',
+            'file_size': 700 * 1024 * 1024 + i,
+            'file_type': 'video',
+            'mime_type': 'video/x-matroska',
+            'caption': f'<b>Some Movie</b> {i}',
+            'file_unique_id': f'AgADfake{i:08d}',
+            'fingerprint': f'{i:032x}',
+        }
+        for i in range(count)
+    ]
+
+
+def render(files):
+    # what auto_filter / next_page / inline read from every result
+    for file in files:
+        (file.file_id, file.file_name, file.file_size, file.file_type, file.caption)
+
+
+def odm_page(docs):
+    render([Media.build_from_mongo(doc) for doc in docs])
+
+
+def raw_page(docs):
+    render([FileRecord(doc) for doc in docs])
+
+
+def measure(fn, pages):
+    cpu = time.process_time()
+    for page in pages:
+        fn(page)
+    cpu = time.process_time() - cpu
+
+    tracemalloc.start()
+    for page in pages[:200]:
+        fn(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu / len(pages), peak
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    docs = make_docs(page_size)
+    projected = [{k: v for k, v in doc.items() if k == '_id' or k in FILE_PROJECTION} for doc in docs]
+
+    print(f"{pages} pages of {page_size} results")
+    print(f"{'path':<6}{'cpu/page':>14}{'peak alloc/page':>18}")
+    results = {}
+    for name, fn, page in (('odm', odm_page, docs), ('raw', raw_page, projected)):
+        cpu, peak = measure(fn, [page] * pages)
+        results[name] = cpu
+        print(f"{name:<6}{cpu * 1e6:>11.1f} us{peak / 1024:>15.1f} KB")
+    print(f"raw path is {results['odm'] / results['raw']:.1f}x faster per page")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,17 @@ from pyrogram.raw.all import layer
 from typing import Union, Optional, AsyncGenerator
 
 # Database modules
-from database.ia_filterdb import Media, Media2, choose_mediaDB, db as clientDB
+from database.ia_filterdb import Media, Media2, choose_mediaDB, load_known_files, save_known_files, db as clientDB
 from database.users_chats_db import db
+from database.filters_mdb import ensure_indexes as ensure_filter_indexes
+from database.clients import warm_clients
+from database.backfill import resume_backfills
+from database.placement import load_placement
+from plugins.index import resume_index_jobs
+from plugins.channel import catch_up_loop, resolve_channels
+from indexer import iter_range, budget as fetch_budget
+from database.ingest_queue import drain_queues
+from userbot import start_userbot, stop_userbot
 from info import (
     SESSION,
     API_ID,
@@ -76,6 +85,15 @@ class Bot(Client):
         self._web_runner = None
 
     async def start(self):
+        # Open the MongoDB connection pools before the first queries need them
+        await warm_clients()
+
+        # Point users/groups/connections/filters at the cluster they were moved to
+        try:
+            await load_placement()
+        except Exception as e:
+            logging.warning(f"Failed to load collection placement: {e}")
+
         # Load banned users/chats
         try:
             b_users, b_chats = await db.get_banned()
@@ -90,9 +108,20 @@ class Bot(Client):
         try:
             await Media.ensure_indexes()
             await Media2.ensure_indexes()
+            await db.ensure_indexes()
+            await ensure_filter_indexes()
         except Exception as e:
             logging.exception("Error ensuring indexes: %s", e)
 
+        # Load known file ids for duplicate checks (rebuilt from both DBs in background if stale)
+        asyncio.create_task(self.load_known_files())
+
+        # Continue backfills that were running when the bot stopped
+        try:
+            await resume_backfills(self)
+        except Exception as e:
+            logging.exception("Failed to resume backfills: %s", e)
+
         # Check DB space and choose DB
         try:
             stats = await clientDB.command("dbStats")
@@ -180,13 +209,45 @@ class Bot(Client):
             await self.stop()
             os._exit(1)
 
+        # Optional user session that index jobs read channel history with
+        await start_userbot()
+
+        # Continue indexes interrupted by the last restart
+        try:
+            await resume_index_jobs(self)
+        except Exception as e:
+            logging.exception("Failed to resume index jobs: %s", e)
+
+        # Match deleted posts of channels given by username, their updates only carry the id
+        try:
+            await resolve_channels(self)
+        except Exception as e:
+            logging.exception("Failed to resolve CHANNELS: %s", e)
+
+        # Index what CHANNELS got while the bot was offline, then keep checking
+        asyncio.create_task(catch_up_loop(self))
+
         # Schedule restart
         try:
             asyncio.create_task(self.schedule_restart(RESTART_INTERVAL))
         except Exception as e:
             logging.exception("Failed to schedule restart: %s", e)
 
+    async def load_known_files(self):
+        try:
+            await load_known_files()
+        except Exception as e:
+            logging.exception("Failed to load known file ids: %s", e)
+
     async def stop(self, *args):
+        # Save the channel posts still waiting in the ingest queues
+        await drain_queues()
+
+        await stop_userbot()
+
+        # Persist known file ids so the next start skips the rebuild
+        await save_known_files()
+
         # Stop web runner first
         try:
             if self._web_runner:
@@ -239,17 +300,9 @@ class Bot(Client):
         limit: int,
         offset: int = 0,
     ) -> Optional[AsyncGenerator["types.Message", None]]:
-        current = offset
-        while True:
-            new_diff = min(200, limit - current)
-            if new_diff <= 0:
-                return
-            messages = await self.get_messages(
-                chat_id, list(range(current, current + new_diff + 1))
-            )
-            for message in messages:
-                yield message
-                current += 1
+        """Messages `offset` to `limit` of a chat in order, several windows fetched at once (see indexer.iter_range)."""
+        async for message in iter_range(self, chat_id, max(offset, 1), limit, budget=fetch_budget):
+            yield message
 
 # Helper: parse_interval
 def parse_interval(interval: str) -> int:
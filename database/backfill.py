@@ -0,0 +1,180 @@
+"""
+Online backfills: rewrite the existing Media/Media2 documents while the bot keeps running.
+
+A backfill is a function registered with @backfill that gets a document (limited to
+`projection`) and returns the update for it, or None to leave it alone. The runner walks
+each db by _id range in batches, applies the updates with one unordered bulk_write per
+batch and checkpoints the last _id in the `backfills` collection, so a restart resumes
+where the run stopped. It slows down while writes take longer than BACKFILL_TARGET_MS.
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from info import LOG_CHANNEL, BACKFILL_BATCH_SIZE, BACKFILL_TARGET_MS
+from database.ia_filterdb import Media, Media2, db, file_fingerprint, save_known_files, _remember_file, _bump_generation
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#checkpoints, one document per backfill
+checkpoints = db.backfills
+BACKFILLS = {}
+RUNNING = {}
+MAX_DELAY = 30       # seconds, longest pause between batches
+REPORT_EVERY = 60    # seconds between progress edits in LOG_CHANNEL
+
+
+class Backfill:
+    def __init__(self, name, transform, filter=None, projection=None, description=''):
+        self.name = name
+        self.transform = transform
+        self.filter = filter or {}
+        self.projection = projection
+        self.description = description
+
+
+def backfill(name, filter=None, projection=None):
+    """Register `fn(doc) -> update or None` as the backfill `name`, only documents matching `filter` are passed to it."""
+    def decorator(fn):
+        BACKFILLS[name] = Backfill(name, fn, filter, projection, (fn.__doc__ or '').strip())
+        return fn
+    return decorator
+
+
+async def get_checkpoint(name):
+    return await checkpoints.find_one({'_id': name})
+
+
+async def _write(collection, ops):
+    try:
+        return (await collection.bulk_write(ops, ordered=False)).modified_count
+    except BulkWriteError as e:
+        logger.warning(f"Backfill batch had {len(e.details.get('writeErrors', []))} write errors")
+        return e.details.get('nModified', 0)
+
+
+async def run_backfill(name, bot=None, batch_size=BACKFILL_BATCH_SIZE, target_ms=BACKFILL_TARGET_MS, restart=False):
+    """
+    Run (or resume) the backfill `name` over both dbs. Progress goes to LOG_CHANNEL through `bot`
+    when given. Returns the finished checkpoint.
+    """
+    job = BACKFILLS[name]
+    if restart:
+        await checkpoints.delete_one({'_id': name})
+    checkpoint = await get_checkpoint(name) or {}
+    if not checkpoint:
+        checkpoint = {'_id': name, 'shards': {}, 'scanned': 0, 'updated': 0, 'done': False, 'started': datetime.utcnow()}
+        await checkpoints.insert_one(checkpoint)
+    if checkpoint.get('done'):
+        return checkpoint
+    scanned, updated = checkpoint.get('scanned', 0), checkpoint.get('updated', 0)
+    report = await _Report.start(bot, name, checkpoint)
+    delay = 0.0
+
+    for shard, document in enumerate((Media, Media2)):
+        last_id = checkpoint['shards'].get(str(shard))
+        while last_id is not True:
+            filter = dict(job.filter)
+            if last_id is not None:
+                filter['_id'] = {'$gt': last_id}
+            docs = await document.collection.find(filter, job.projection).sort('_id', 1).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                # True marks a finished db
+                last_id = True
+            else:
+                ops = []
+                for doc in docs:
+                    update = job.transform(doc)
+                    if update:
+                        ops.append(UpdateOne({'_id': doc['_id']}, update))
+                start = time.monotonic()
+                if ops:
+                    await _bump_generation()
+                    updated += await _write(document.collection, ops)
+                latency = (time.monotonic() - start) * 1000
+                scanned += len(docs)
+                last_id = docs[-1]['_id']
+                # back off while the db is slower than the target, speed up again once it isn't
+                delay = min(max(delay * 2, 0.1), MAX_DELAY) if latency > target_ms else delay / 2
+            await checkpoints.update_one({'_id': name}, {'$set': {f'shards.{shard}': last_id, 'scanned': scanned, 'updated': updated}})
+            await report.update(scanned, updated)
+            if delay >= 0.01:
+                await asyncio.sleep(delay)
+
+    checkpoint = await checkpoints.find_one_and_update(
+        {'_id': name}, {'$set': {'done': True, 'finished': datetime.utcnow()}}, return_document=ReturnDocument.AFTER
+    )
+    # backfills like fingerprint add keys to the known files, keep the snapshot up to date with them
+    await save_known_files()
+    await report.finish(scanned, updated)
+    logger.info(f"Backfill {name} done. Scanned:{scanned} updated:{updated}")
+    return checkpoint
+
+
+def start_backfill(name, bot=None, restart=False):
+    """Run the backfill `name` in the background, returns False when it is already running."""
+    if name in RUNNING and not RUNNING[name].done():
+        return False
+    RUNNING[name] = asyncio.create_task(_guarded(name, bot, restart))
+    return True
+
+
+async def _guarded(name, bot, restart):
+    try:
+        await run_backfill(name, bot, restart=restart)
+    except Exception as e:
+        logger.exception(f"Backfill {name} stopped, it resumes on the next start: {e}")
+
+
+async def resume_backfills(bot=None):
+    """Restart every registered backfill that was started but not finished, on bot start."""
+    async for checkpoint in checkpoints.find({'done': False}):
+        if checkpoint['_id'] in BACKFILLS:
+            logger.info(f"Resuming backfill {checkpoint['_id']}")
+            start_backfill(checkpoint['_id'], bot)
+
+
+class _Report:
+    """Progress message of a backfill in LOG_CHANNEL, edited at most every REPORT_EVERY seconds."""
+
+    def __init__(self, bot, name, message):
+        self.bot, self.name, self.message = bot, name, message
+        self.last_edit = time.monotonic()
+
+    @classmethod
+    async def start(cls, bot, name, checkpoint):
+        message = None
+        if bot and LOG_CHANNEL:
+            try:
+                message = await bot.send_message(LOG_CHANNEL, f"#Backfill <code>{name}</code> {'resumed' if checkpoint.get('scanned') else 'started'}")
+            except Exception as e:
+                logger.warning(f"Could not report backfill progress: {e}")
+        return cls(bot, name, message)
+
+    async def _edit(self, text):
+        if self.message:
+            try:
+                await self.message.edit(text)
+            except Exception:
+                pass
+
+    async def update(self, scanned, updated):
+        if time.monotonic() - self.last_edit < REPORT_EVERY:
+            return
+        self.last_edit = time.monotonic()
+        await self._edit(f"#Backfill <code>{self.name}</code> running\nScanned: <code>{scanned}</code>\nUpdated: <code>{updated}</code>")
+
+    async def finish(self, scanned, updated):
+        await self._edit(f"#Backfill <code>{self.name}</code> finished ✅\nScanned: <code>{scanned}</code>\nUpdated: <code>{updated}</code>")
+
+
+@backfill('fingerprint', filter={'fingerprint': {'$exists': False}}, projection={'file_name': 1, 'file_size': 1, 'mime_type': 1})
+def add_fingerprint(doc):
+    """Fingerprint files indexed before fingerprints existed, so re-uploads of them are caught."""
+    fingerprint = file_fingerprint(doc.get('file_name'), doc.get('file_size'), doc.get('mime_type'))
+    # merge_reupload only looks up fingerprints the known files have seen
+    _remember_file(None, fingerprint=fingerprint)
+    return {'$set': {'fingerprint': fingerprint}}
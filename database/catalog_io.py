@@ -0,0 +1,163 @@
+"""
+Streaming export and import of the Media/Media2 catalog, to move the index between clusters
+without re-indexing the channels.
+
+Files are gzip compressed, BSON (`.bson.gz`, exact types, fastest) or NDJSON in MongoDB
+extended json (`.ndjson.gz`, readable). Both are written and read batch by batch, so memory
+use doesn't grow with the catalog.
+
+    python -m database.catalog_io export <all|media|media2> <file>
+    python -m database.catalog_io import <file> <media|media2> [--restart]
+"""
+import os
+import sys
+import gzip
+import json
+import asyncio
+import logging
+from itertools import islice
+import bson
+from bson import json_util
+from database.ia_filterdb import Media, Media2, file_fingerprint, insert_docs, load_known_files
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BATCH_SIZE = 1000
+SHARDS = {'all': (Media, Media2), 'media': (Media,), 'media2': (Media2,)}
+TARGETS = {'media': Media, 'media2': Media2}
+
+
+def _is_ndjson(path):
+    return '.ndjson' in os.path.basename(path) or '.json' in os.path.basename(path)
+
+
+def _write_batch(out, docs, ndjson):
+    if ndjson:
+        out.write(b''.join((json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n').encode() for doc in docs))
+    else:
+        out.write(b''.join(bson.encode(doc) for doc in docs))
+
+
+def _read_docs(stream, ndjson):
+    if ndjson:
+        return (json_util.loads(line) for line in stream if line.strip())
+    return bson.decode_file_iter(stream)
+
+
+async def export_catalog(path, shards='all', batch_size=BATCH_SIZE, progress=None):
+    """
+    Write every file of `shards` ('all', 'media' or 'media2') to `path` in _id order.
+    The file only appears under `path` once complete. `progress` is an optional
+    coroutine called with the number of files written after every batch. Returns that number.
+    """
+    ndjson = _is_ndjson(path)
+    written = 0
+    part = f"{path}.part"
+    out = gzip.open(part, 'wb', compresslevel=6)
+    try:
+        for document in SHARDS[shards]:
+            batch = []
+            async for doc in document.collection.find({}, batch_size=batch_size).sort('_id', 1):
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    # compression runs in a thread so the bot keeps answering meanwhile
+                    await asyncio.to_thread(_write_batch, out, batch, ndjson)
+                    written += len(batch)
+                    batch = []
+                    if progress:
+                        await progress(written)
+            if batch:
+                await asyncio.to_thread(_write_batch, out, batch, ndjson)
+                written += len(batch)
+        await asyncio.to_thread(out.close)
+    except BaseException:
+        out.close()
+        os.remove(part)
+        raise
+    os.replace(part, path)
+    logger.info(f"Exported {written} files from {shards} to {path}")
+    return written
+
+
+def _load_checkpoint(path, target):
+    try:
+        with open(f"{path}.import") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    return checkpoint.get('done', 0) if checkpoint.get('target') == target else 0
+
+
+def _save_checkpoint(path, target, done):
+    with open(f"{path}.import.tmp", 'w') as f:
+        json.dump({'target': target, 'done': done}, f)
+    os.replace(f"{path}.import.tmp", f"{path}.import")
+
+
+async def import_catalog(path, target='media', batch_size=BATCH_SIZE, progress=None, restart=False):
+    """
+    Bulk load an export into `target` ('media' or 'media2').
+    Files already stored in either db are skipped, so an import can be repeated safely.
+    Progress is checkpointed next to the file (`<path>.import`) after every batch and an
+    interrupted import resumes from there unless `restart` is set.
+    `progress` is an optional coroutine called with (read, inserted, duplicates).
+    Returns (read, inserted, duplicates, errors).
+    """
+    ndjson = _is_ndjson(path)
+    document = TARGETS[target]
+    done = 0 if restart else _load_checkpoint(path, target)
+    read = inserted = duplicates = errors = 0
+    stream = gzip.open(path, 'rt' if ndjson else 'rb')
+    try:
+        docs = _read_docs(stream, ndjson)
+        if done:
+            logger.info(f"Resuming import of {path} after {done} files")
+            await asyncio.to_thread(lambda: sum(1 for _ in islice(docs, done)))
+            read = done
+        while True:
+            batch = await asyncio.to_thread(lambda: list(islice(docs, batch_size)))
+            if not batch:
+                break
+            for doc in batch:
+                if not doc.get('fingerprint'):
+                    doc['fingerprint'] = file_fingerprint(doc.get('file_name'), doc.get('file_size'), doc.get('mime_type'))
+            for saved, status in await insert_docs(batch, document):
+                if saved:
+                    inserted += 1
+                elif status == 0:
+                    duplicates += 1
+                else:
+                    errors += 1
+            read += len(batch)
+            _save_checkpoint(path, target, read)
+            if progress:
+                await progress(read, inserted, duplicates)
+    finally:
+        stream.close()
+    if os.path.exists(f"{path}.import"):
+        os.remove(f"{path}.import")
+    logger.info(f"Imported {path} into {target}. Read:{read} inserted:{inserted} duplicates:{duplicates} errors:{errors}")
+    # a running bot notices the import by the generation counter, this rebuilds the snapshot for its next start
+    await load_known_files(rebuild=True)
+    return read, inserted, duplicates, errors
+
+
+async def _main(args):
+    async def report(*counts):
+        print(*counts, end='\r', flush=True)
+
+    if len(args) >= 3 and args[0] == 'export' and args[1] in SHARDS:
+        print(f"\n{await export_catalog(args[2], args[1], progress=report)} files exported")
+    elif len(args) >= 3 and args[0] == 'import' and args[2] in TARGETS:
+        read, inserted, duplicates, errors = await import_catalog(args[1], args[2], progress=report, restart='--restart' in args)
+        print(f"\nread {read}, inserted {inserted}, duplicates {duplicates}, errors {errors}")
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # the motor clients are bound to the loop that was current at import time, like in bot.py
+    asyncio.get_event_loop().run_until_complete(_main(sys.argv[1:]))
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from info import MONGO_MIN_POOL_SIZE, MONGO_MAX_POOL_SIZE, MONGO_MAX_IDLE_MS, MONGO_SERVER_SELECTION_MS, MONGO_COMPRESSORS, SEARCH_READ_PREFERENCE, SEARCH_MAX_STALENESS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#one client (and so one connection pool) per uri for the whole process
+_clients = {}
+
+READ_MODES = {
+    'primarypreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondarypreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def read_preference(mode, max_staleness=-1):
+    """Read preference for a mode name as used in mongodb uris, e.g. 'secondaryPreferred'."""
+    if mode.lower() == 'primary':
+        return Primary()
+    if mode.lower() not in READ_MODES:
+        raise ValueError(f"Unknown read preference {mode!r}")
+    return READ_MODES[mode.lower()](max_staleness=max_staleness)
+
+
+#where search and count queries go, so indexing writes on the primary don't slow them down
+search_read_preference = read_preference(SEARCH_READ_PREFERENCE, SEARCH_MAX_STALENESS)
+
+
+def client_options():
+    return dict(
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_MS,
+        compressors=MONGO_COMPRESSORS,
+    )
+
+
+def get_client(uri):
+    """Shared AsyncIOMotorClient for `uri`, created on first use with the pool and compression settings from info.py."""
+    client = _clients.get(uri)
+    if client is None:
+        client = _clients[uri] = AsyncIOMotorClient(uri, **client_options())
+    return client
+
+
+async def warm_clients():
+    """Open MONGO_MIN_POOL_SIZE connections on every client so the first requests after start don't pay for the handshakes."""
+    for uri, client in list(_clients.items()):
+        try:
+            await asyncio.gather(*(client.admin.command('ping') for _ in range(max(MONGO_MIN_POOL_SIZE, 1))))
+        except Exception as e:
+            logger.warning(f"Could not warm up connections to {'the default host' if uri is None else 'a database'}: {e}")
@@ -1,21 +1,18 @@
-import pymongo
-from sample_info import tempDict
-from info import DATABASE_URI, DATABASE_NAME, SECONDDB_URI
+from database import placement
 
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
-myclient = pymongo.MongoClient(DATABASE_URI)
-mydb = myclient[DATABASE_NAME]
-mycol = mydb['CONNECTION']  
 
-myclient2 = pymongo.MongoClient(SECONDDB_URI)
-mydb2 = myclient2[DATABASE_NAME]
-mycol2 = mydb2['CONNECTION']
+def _collections():
+    """CONNECTION where COLLECTION_PLACEMENT puts it, and on the other cluster for connections saved before."""
+    return placement.collection('connections'), placement.other_collection('connections')
+
 
 async def add_connection(group_id, user_id):
-    query = mycol.find_one(
+    mycol, mycol2 = _collections()
+    query = await mycol.find_one(
         { "_id": user_id },
         { "_id": 0, "active_group": 0 }
     )
@@ -34,21 +31,17 @@ async def add_connection(group_id, user_id):
         'active_group' : group_id,
     }
 
-    if mycol.count_documents( {"_id": user_id} ) == 0 and mycol2.count_documents( {"_id": user_id} ) == 0:
+    if await mycol.count_documents( {"_id": user_id} ) == 0 and await mycol2.count_documents( {"_id": user_id} ) == 0:
         try:
-            if tempDict['indexDB'] == DATABASE_URI:
-                mycol.insert_one(data)
-                return True
-            else:
-                mycol2.insert_one(data)
-                return True
+            await mycol.insert_one(data)
+            return True
         except:
             logger.exception('Some error occurred!', exc_info=True)
 
     else:
         try:
-            if mycol.count_documents( {"_id": user_id} ) == 0:
-                mycol2.update_one(
+            if await mycol.count_documents( {"_id": user_id} ) == 0:
+                await mycol2.update_one(
                     {'_id': user_id},
                     {
                         "$push": {"group_details": group_details},
@@ -57,7 +50,7 @@ async def add_connection(group_id, user_id):
                 )
                 return True
             else:
-                mycol.update_one(
+                await mycol.update_one(
                     {'_id': user_id},
                     {
                         "$push": {"group_details": group_details},
@@ -70,12 +63,12 @@ async def add_connection(group_id, user_id):
 
         
 async def active_connection(user_id):
-
-    query = mycol.find_one(
+    mycol, mycol2 = _collections()
+    query = await mycol.find_one(
         { "_id": user_id },
         { "_id": 0, "group_details": 0 }
     )
-    query2 = mycol2.find_one(
+    query2 = await mycol2.find_one(
         { "_id": user_id },
         { "_id": 0, "group_details": 0 }
     )
@@ -89,11 +82,12 @@ async def active_connection(user_id):
         return int(group_id) if group_id != None else None
 
 async def all_connections(user_id):
-    query = mycol.find_one(
+    mycol, mycol2 = _collections()
+    query = await mycol.find_one(
         { "_id": user_id },
         { "_id": 0, "active_group": 0 }
     )
-    query2 = mycol2.find_one(
+    query2 = await mycol2.find_one(
         { "_id": user_id },
         { "_id": 0, "active_group": 0 }
     )
@@ -106,12 +100,13 @@ async def all_connections(user_id):
 
 
 async def if_active(user_id, group_id):
-    query = mycol.find_one(
+    mycol, mycol2 = _collections()
+    query = await mycol.find_one(
         { "_id": user_id },
         { "_id": 0, "group_details": 0 }
     )
     if query is None:
-        query = mycol2.find_one(
+        query = await mycol2.find_one(
             { "_id": user_id },
             { "_id": 0, "group_details": 0 }
         )
@@ -119,12 +114,13 @@ async def if_active(user_id, group_id):
 
 
 async def make_active(user_id, group_id):
-    update = mycol.update_one(
+    mycol, mycol2 = _collections()
+    update = await mycol.update_one(
         {'_id': user_id},
         {"$set": {"active_group" : group_id}}
     )
     if update.modified_count == 0:
-        update = mycol2.update_one(
+        update = await mycol2.update_one(
             {'_id': user_id},
             {"$set": {"active_group" : group_id}}
         )
@@ -132,12 +128,13 @@ async def make_active(user_id, group_id):
 
 
 async def make_inactive(user_id):
-    update = mycol.update_one(
+    mycol, mycol2 = _collections()
+    update = await mycol.update_one(
         {'_id': user_id},
         {"$set": {"active_group" : None}}
     )
     if update.modified_count == 0:
-        update = mycol2.update_one(
+        update = await mycol2.update_one(
             {'_id': user_id},
             {"$set": {"active_group" : None}}
         )
@@ -145,21 +142,21 @@ async def make_inactive(user_id):
 
 
 async def delete_connection(user_id, group_id):
-
+    mycol, mycol2 = _collections()
     try:
-        update = mycol.update_one(
+        update = await mycol.update_one(
             {"_id": user_id},
             {"$pull" : { "group_details" : {"group_id":group_id} } }
         )
         if update.modified_count == 0:
-            update = mycol2.update_one(
+            update = await mycol2.update_one(
                 {"_id": user_id},
                 {"$pull" : { "group_details" : {"group_id":group_id} } }
             )
             if update.modified_count == 0:
                 return False
             else:
-                query = mycol2.find_one(
+                query = await mycol2.find_one(
                     { "_id": user_id },
                     { "_id": 0 }
                 )
@@ -167,18 +164,18 @@ async def delete_connection(user_id, group_id):
                     if query['active_group'] == group_id:
                         prvs_group_id = query["group_details"][len(query["group_details"]) - 1]["group_id"]
 
-                        mycol2.update_one(
+                        await mycol2.update_one(
                             {'_id': user_id},
                             {"$set": {"active_group" : prvs_group_id}}
                         )
                 else:
-                    mycol2.update_one(
+                    await mycol2.update_one(
                         {'_id': user_id},
                         {"$set": {"active_group" : None}}
                     )
                 return True
         else:
-            query = mycol.find_one(
+            query = await mycol.find_one(
                 { "_id": user_id },
                 { "_id": 0 }
             )
@@ -186,12 +183,12 @@ async def delete_connection(user_id, group_id):
                 if query['active_group'] == group_id:
                     prvs_group_id = query["group_details"][len(query["group_details"]) - 1]["group_id"]
 
-                    mycol.update_one(
+                    await mycol.update_one(
                         {'_id': user_id},
                         {"$set": {"active_group" : prvs_group_id}}
                     )
             else:
-                mycol.update_one(
+                await mycol.update_one(
                     {'_id': user_id},
                     {"$set": {"active_group" : None}}
                 )
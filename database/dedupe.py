@@ -0,0 +1,77 @@
+import logging
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from database.ia_filterdb import Media, Media2, file_fingerprint, load_known_files, forget_file, _bump_generation
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def collapse_duplicates(batch_size=500, progress=None):
+    """
+    One-off job that removes re-uploads already stored in Media/Media2.
+    Files are grouped by file_unique_id and fingerprint across both dbs, the first copy
+    (primary db first, oldest first) is kept and the rest are deleted in batches of `batch_size`.
+    Kept files that predate fingerprints get one afterwards so save_file can match re-uploads of them.
+    `progress` is an optional coroutine called with (scanned, removed) after every batch.
+    Returns (scanned, removed, fingerprinted).
+    """
+    seen = set()
+    seen_unique = set()
+    scanned = removed = fingerprinted = 0
+    projection = {'file_name': 1, 'file_size': 1, 'mime_type': 1, 'file_unique_id': 1, 'fingerprint': 1}
+
+    # pass 1: delete every copy after the first, before any fingerprint is written,
+    # so the unique fingerprint index can't reject the kept copy's fingerprint
+    for collection in (Media.collection, Media2.collection):
+        to_delete = []
+        async for doc in collection.find({}, projection, batch_size=batch_size):
+            scanned += 1
+            fingerprint = doc.get('fingerprint') or file_fingerprint(doc.get('file_name'), doc.get('file_size'), doc.get('mime_type'))
+            unique_id = doc.get('file_unique_id')
+            if fingerprint in seen or (unique_id and unique_id in seen_unique):
+                to_delete.append(doc['_id'])
+            else:
+                seen.add(fingerprint)
+                if unique_id:
+                    seen_unique.add(unique_id)
+            if len(to_delete) >= batch_size:
+                removed += (await collection.delete_many({'_id': {'$in': to_delete}})).deleted_count
+                to_delete = []
+            if progress and scanned % batch_size == 0:
+                await progress(scanned, removed)
+        if to_delete:
+            removed += (await collection.delete_many({'_id': {'$in': to_delete}})).deleted_count
+    seen.clear()
+    seen_unique.clear()
+
+    # pass 2: fingerprint the files that were kept
+    await _bump_generation()
+    for collection in (Media.collection, Media2.collection):
+        updates = []
+        async for doc in collection.find({'fingerprint': {'$exists': False}}, projection, batch_size=batch_size):
+            fingerprint = file_fingerprint(doc.get('file_name'), doc.get('file_size'), doc.get('mime_type'))
+            updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'fingerprint': fingerprint}}))
+            if len(updates) >= batch_size:
+                fingerprinted += await _write_fingerprints(collection, updates)
+                updates = []
+        if updates:
+            fingerprinted += await _write_fingerprints(collection, updates)
+
+    if removed:
+        forget_file()
+    if progress:
+        await progress(scanned, removed)
+    logger.info(f"Duplicate collapse done. Scanned:{scanned} removed:{removed} fingerprinted:{fingerprinted}")
+    # rebuilt even when nothing was removed, the snapshot doesn't have the new fingerprints
+    await load_known_files(rebuild=True)
+    return scanned, removed, fingerprinted
+
+
+async def _write_fingerprints(collection, updates):
+    try:
+        result = await collection.bulk_write(updates, ordered=False)
+        return result.modified_count
+    except BulkWriteError as e:
+        logger.warning(f"Some fingerprints were not written: {len(e.details.get('writeErrors', []))} errors")
+        return e.details.get('nModified', 0)
@@ -0,0 +1,84 @@
+import os
+import math
+import json
+import struct
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#snapshot header: magic, version, size in bits, hashes, items added, length of the json meta blob
+HEADER = struct.Struct("<4sBQBQI")
+MAGIC = b"KBLM"
+VERSION = 1
+
+
+class BloomFilter:
+    """Fixed size bloom filter used to skip duplicate probes for keys that were never stored."""
+
+    def __init__(self, capacity, error_rate=0.001, size=None, hashes=None, bits=None, count=0):
+        capacity = max(int(capacity), 1)
+        if size is None:
+            size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        if hashes is None:
+            hashes = max(1, int(round(size / capacity * math.log(2))))
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+        self.count = count
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def capacity(self):
+        """Keys it was sized for, past them the false positive rate climbs above the configured one."""
+        return int(self.size * math.log(2) / self.hashes)
+
+
+def dump_bloom(bloom, path, meta=None):
+    """Write the filter to `path` atomically, `meta` is stored next to the bits as json."""
+    blob = json.dumps(meta or {}).encode()
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, bloom.size, bloom.hashes, bloom.count, len(blob)))
+        f.write(blob)
+        f.write(bloom.bits)
+    os.replace(tmp, path)
+
+
+def load_bloom(path):
+    """Return (bloom, meta) from a snapshot written by dump_bloom, or (None, None) if it is missing or corrupt."""
+    if not path or not os.path.exists(path):
+        return None, None
+    try:
+        with open(path, "rb") as f:
+            magic, version, size, hashes, count, meta_len = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                logger.warning(f"Ignoring bloom snapshot {path} with unknown format")
+                return None, None
+            meta = json.loads(f.read(meta_len) or b"{}")
+            bits = bytearray(f.read())
+    except Exception as e:
+        logger.warning(f"Could not read bloom snapshot {path}: {e}")
+        return None, None
+    if len(bits) != (size + 7) // 8:
+        logger.warning(f"Ignoring truncated bloom snapshot {path}")
+        return None, None
+    return BloomFilter(1, size=size, hashes=hashes, bits=bits, count=count), meta
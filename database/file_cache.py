@@ -0,0 +1,95 @@
+import time
+import hashlib
+from collections import OrderedDict
+
+
+class _Counters:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self, size):
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class TTLCache(_Counters):
+    """LRU cache whose entries also expire `ttl` seconds after they were set."""
+
+    def __init__(self, maxsize=5000, ttl=600):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return super().stats(len(self._data))
+
+
+class ShardRoutes(_Counters):
+    """
+    Which db (0 = Media, 1 = Media2) holds a file_id, so lookups go straight to it.
+    Keys are 8 byte digests of the file_id to keep the map small, the oldest routes
+    are dropped past `maxsize`. A wrong route only costs the fallback lookup.
+    """
+
+    def __init__(self, maxsize=500000):
+        super().__init__()
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    @staticmethod
+    def _key(file_id):
+        return hashlib.blake2b(file_id.encode(), digest_size=8).digest()
+
+    def get(self, file_id):
+        shard = self._data.get(self._key(file_id))
+        if shard is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return shard
+
+    def set(self, file_id, shard):
+        key = self._key(file_id)
+        self._data[key] = shard
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, file_id):
+        self._data.pop(self._key(file_id), None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return super().stats(len(self._data))
@@ -1,18 +1,33 @@
-import pymongo
 from pyrogram import enums
-from info import DATABASE_URI, DATABASE_NAME
+from database.placement import database, FILTER_COLLECTION
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
-myclient = pymongo.MongoClient(DATABASE_URI)
-mydb = myclient[DATABASE_NAME]
 
+def filters_db():
+    """Database with the filter collections, one per group named after its id."""
+    return database('filters')
+
+
+#filter collections with their text index, so add_filter only creates it for a group's first filter
+INDEXED = set()
+
+
+async def ensure_indexes():
+    """Index text in every group's filter collection, collections are named after the group id."""
+    mydb = filters_db()
+    for name in await mydb.list_collection_names(filter={'name': {'$regex': FILTER_COLLECTION.pattern}}):
+        await mydb[name].create_index('text')
+        INDEXED.add(name)
 
 
 async def add_filter(grp_id, text, reply_text, btn, file, alert):
-    mycol = mydb[str(grp_id)]
-    # mycol.create_index([('text', 'text')])
+    mycol = filters_db()[str(grp_id)]
+    # find_filter/delete_filter look filters up by text, groups without filters at startup get the index here
+    if mycol.name not in INDEXED:
+        await mycol.create_index('text')
+        INDEXED.add(mycol.name)
 
     data = {
         'text':str(text),
@@ -23,18 +38,18 @@ async def add_filter(grp_id, text, reply_text, btn, file, alert):
     }
 
     try:
-        mycol.update_one({'text': str(text)},  {"$set": data}, upsert=True)
+        await mycol.update_one({'text': str(text)},  {"$set": data}, upsert=True)
     except:
         logger.exception('Some error occured!', exc_info=True)
              
      
 async def find_filter(group_id, name):
-    mycol = mydb[str(group_id)]
+    mycol = filters_db()[str(group_id)]
     
     query = mycol.find( {"text":name})
     # query = mycol.find( { "$text": {"$search": name}})
     try:
-        for file in query:
+        async for file in query:
             reply_text = file['reply']
             btn = file['btn']
             fileid = file['file']
@@ -48,12 +63,12 @@ async def find_filter(group_id, name):
 
 
 async def get_filters(group_id):
-    mycol = mydb[str(group_id)]
+    mycol = filters_db()[str(group_id)]
 
     texts = []
     query = mycol.find()
     try:
-        for file in query:
+        async for file in query:
             text = file['text']
             texts.append(text)
     except:
@@ -62,12 +77,12 @@ async def get_filters(group_id):
 
 
 async def delete_filter(message, text, group_id):
-    mycol = mydb[str(group_id)]
+    mycol = filters_db()[str(group_id)]
     
     myquery = {'text':text }
-    query = mycol.count_documents(myquery)
+    query = await mycol.count_documents(myquery)
     if query == 1:
-        mycol.delete_one(myquery)
+        await mycol.delete_one(myquery)
         await message.reply_text(
             f"'`{text}`'  deleted. I'll not respond to that filter anymore.",
             quote=True,
@@ -78,13 +93,15 @@ async def delete_filter(message, text, group_id):
 
 
 async def del_all(message, group_id, title):
-    if str(group_id) not in mydb.list_collection_names():
+    mydb = filters_db()
+    if str(group_id) not in await mydb.list_collection_names():
         await message.edit_text(f"Nothing to remove in {title}!")
         return
 
     mycol = mydb[str(group_id)]
     try:
-        mycol.drop()
+        await mycol.drop()
+        INDEXED.discard(mycol.name)
         await message.edit_text(f"All filters from {title} has been removed")
     except:
         await message.edit_text("Couldn't remove all filters from group!")
@@ -92,22 +109,21 @@ async def del_all(message, group_id, title):
 
 
 async def count_filters(group_id):
-    mycol = mydb[str(group_id)]
+    mycol = filters_db()[str(group_id)]
 
-    count = mycol.count()
+    count = await mycol.count_documents({})
     return False if count == 0 else count
 
 
 async def filter_stats():
-    collections = mydb.list_collection_names()
-
-    if "CONNECTION" in collections:
-        collections.remove("CONNECTION")
+    mydb = filters_db()
+    # only the group filter collections, not users, groups, files...
+    collections = [name for name in await mydb.list_collection_names() if FILTER_COLLECTION.match(name)]
 
     totalcount = 0
     for collection in collections:
         mycol = mydb[collection]
-        count = mycol.count()
+        count = await mycol.count_documents({})
         totalcount += count
 
     totalcollections = len(collections)
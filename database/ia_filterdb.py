@@ -1,25 +1,49 @@
-
+import time
+import asyncio
 import logging
 from struct import pack
 import re
 import base64
+import hashlib
 from pyrogram.file_id import FileId
-from pymongo.errors import DuplicateKeyError
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, PyMongoError, ExecutionTimeout
+from pymongo.write_concern import WriteConcern
+from pymongo.read_preferences import Primary
 from umongo import Instance, Document, fields
-from motor.motor_asyncio import AsyncIOMotorClient
 from marshmallow.exceptions import ValidationError
-from info import DATABASE_URI, DATABASE_NAME, COLLECTION_NAME, USE_CAPTION_FILTER, MAX_B_TN, SECONDDB_URI
+from info import DATABASE_URI, DATABASE_NAME, COLLECTION_NAME, USE_CAPTION_FILTER, MAX_B_TN, SECONDDB_URI, FILE_BLOOM_PATH, FILE_BLOOM_CAPACITY, FILE_BLOOM_ERROR_RATE, INDEX_WRITE_CONCERN, FILE_CACHE_SIZE, FILE_CACHE_TTL, FILE_ROUTES_SIZE, SHARD_FAILURE_THRESHOLD, SHARD_COOLDOWN, SHARD_SLOW_MS, SEARCH_BUDGET_GROUP_MS
 from utils import get_settings, save_group_settings
 from sample_info import tempDict 
+from database.file_bloom import BloomFilter, dump_bloom, load_bloom
+from database.file_cache import TTLCache, ShardRoutes
+from database.clients import get_client, search_read_preference
+from database.shard_health import ShardHealth
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 #some basic variables needed
 saveMedia = None
+#bloom filter of every _id, file_unique_id and fingerprint stored in Media and Media2, None until load_known_files() finishes
+known_files = None
+#filter being rebuilt by load_known_files(), new ids are added to it too so none are lost in the swap
+_building_files = None
+#what the bloom filter holds, snapshots written with other contents are rebuilt
+KNOWN_FILES_KEYS = 'id,file_unique_id,fingerprint'
+#FileRecords by file_id for get_file_details, and which db (0 = Media, 1 = Media2) holds a file_id
+file_cache = TTLCache(FILE_CACHE_SIZE, FILE_CACHE_TTL)
+file_routes = ShardRoutes(FILE_ROUTES_SIZE)
+#extra time the bot waits past a query budget, so mongodb's own maxTimeMS normally ends the query first
+BUDGET_GRACE = 0.2
+#circuit breakers of Media and Media2, searches and lookups skip a db that stopped answering
+shard_health = (
+    ShardHealth('Media', SHARD_FAILURE_THRESHOLD, SHARD_COOLDOWN, SHARD_SLOW_MS),
+    ShardHealth('Media2', SHARD_FAILURE_THRESHOLD, SHARD_COOLDOWN, SHARD_SLOW_MS),
+)
 
 #primary db
-client = AsyncIOMotorClient(DATABASE_URI)
+client = get_client(DATABASE_URI)
 db = client[DATABASE_NAME]
 instance = Instance.from_db(db)
 
@@ -32,13 +56,22 @@ class Media(Document):
     file_type = fields.StrField(allow_none=True)
     mime_type = fields.StrField(allow_none=True)
     caption = fields.StrField(allow_none=True)
+    file_unique_id = fields.StrField(allow_none=True)
+    fingerprint = fields.StrField(allow_none=True)
+    chat_id = fields.IntField(allow_none=True)
+    message_id = fields.IntField(allow_none=True)
 
     class Meta:
-        indexes = ('$file_name', )
+        indexes = (
+            '$file_name',
+            IndexModel('file_unique_id', unique=True, sparse=True),
+            IndexModel('fingerprint', unique=True, sparse=True),
+            IndexModel([('chat_id', 1), ('message_id', 1)], partialFilterExpression={'chat_id': {'$exists': True}}),
+        )
         collection_name = COLLECTION_NAME
 
 #secondary db
-client2 = AsyncIOMotorClient(SECONDDB_URI)
+client2 = get_client(SECONDDB_URI)
 db2 = client2[DATABASE_NAME]
 instance2 = Instance.from_db(db2)
 
@@ -51,11 +84,87 @@ class Media2(Document):
     file_type = fields.StrField(allow_none=True)
     mime_type = fields.StrField(allow_none=True)
     caption = fields.StrField(allow_none=True)
+    file_unique_id = fields.StrField(allow_none=True)
+    fingerprint = fields.StrField(allow_none=True)
+    chat_id = fields.IntField(allow_none=True)
+    message_id = fields.IntField(allow_none=True)
 
     class Meta:
-        indexes = ('$file_name', )
+        indexes = (
+            '$file_name',
+            IndexModel('file_unique_id', unique=True, sparse=True),
+            IndexModel('fingerprint', unique=True, sparse=True),
+            IndexModel([('chat_id', 1), ('message_id', 1)], partialFilterExpression={'chat_id': {'$exists': True}}),
+        )
         collection_name = COLLECTION_NAME
 
+#fields read by the plugins, search results and file lookups fetch only these
+FILE_PROJECTION = {'file_name': 1, 'file_size': 1, 'file_type': 1, 'mime_type': 1, 'caption': 1}
+
+class FileRecord:
+    """Lightweight read-only file built straight from a raw document, with the same attributes as Media."""
+    __slots__ = ('file_id', 'file_name', 'file_size', 'file_type', 'mime_type', 'caption')
+
+    def __init__(self, doc):
+        self.file_id = doc['_id']
+        self.file_name = doc.get('file_name')
+        self.file_size = doc.get('file_size')
+        self.file_type = doc.get('file_type')
+        self.mime_type = doc.get('mime_type')
+        self.caption = doc.get('caption')
+
+    def __repr__(self):
+        return f"FileRecord({self.file_id!r}, {self.file_name!r})"
+
+class ShardResults(list):
+    """Results of a search or lookup, `partial` is True when a db was skipped or failed so some may be missing."""
+    partial = False
+
+async def on_shard(shard, call, default=None, budget_ms=None):
+    """
+    Await `call()` against db `shard` (0 = Media, 1 = Media2) through its circuit breaker,
+    cancelling it once `budget_ms` (plus BUDGET_GRACE) is spent.
+    Returns (result, True), or (default, False) when the db is skipped, the call fails or runs out of time.
+    """
+    health = shard_health[shard]
+    if not health.allow():
+        return default, False
+    start = time.monotonic()
+    try:
+        if budget_ms is None:
+            result = await call()
+        else:
+            result = await asyncio.wait_for(call(), budget_ms / 1000 + BUDGET_GRACE)
+    except ExecutionTimeout:
+        # the server answered that the query ran out of maxTimeMS: slow, not broken, it only counts towards the latency average
+        health.success((time.monotonic() - start) * 1000)
+        logger.info(f"{health.name} query went over its {budget_ms}ms budget")
+        return default, False
+    except asyncio.TimeoutError:
+        # no answer at all, even past maxTimeMS and BUDGET_GRACE: hung or unreachable, so it counts as a failure
+        health.failure((time.monotonic() - start) * 1000, 'no answer within the budget')
+        logger.warning(f"{health.name} did not answer within {budget_ms}ms")
+        return default, False
+    except PyMongoError as e:
+        health.failure((time.monotonic() - start) * 1000, e)
+        logger.warning(f"{health.name} call failed: {e}")
+        return default, False
+    health.success((time.monotonic() - start) * 1000)
+    return result, True
+
+def _time_left(deadline):
+    """Milliseconds left until `deadline` (a time.monotonic() value), None when there is no deadline."""
+    if deadline is None:
+        return None
+    return max(int((deadline - time.monotonic()) * 1000), 1)
+
+#search results are only cached when they come from the primary, a secondary may still have files that were deleted
+CACHE_SEARCH_RESULTS = isinstance(search_read_preference, Primary)
+
+def search_collection(document):
+    """Raw collection of `document` for search traffic, read from the members picked by SEARCH_READ_PREFERENCE."""
+    return document.collection.with_options(read_preference=search_read_preference)
+
 async def choose_mediaDB():
     """This Function chooses which database to use based on the value of indexDB key in the dict tempDict."""
     global saveMedia
@@ -66,16 +175,186 @@ async def choose_mediaDB():
         logger.info("Using second db (Media2)")
         saveMedia = Media2
 
+#counter writes that add file keys bump (batches before writing, single files within a second after), so snapshots miss no keys another process (like the
+#catalog_io CLI) added: a snapshot is only fresh while the counter is where it was when it was saved
+generations = db.known_files
+#counter value the known files were loaded or rebuilt at, None until then
+_generation = None
+#bumps made by this process since, their keys are in the known files
+_own_writes = 0
+#single file saves (save_file, merge_reupload) share one bump a second instead of one round trip each
+_pending_bump = None
+#keys per file in the known files (id, file_unique_id, fingerprint), and room for the catalog to grow
+#before the filter is rebuilt bigger
+KEYS_PER_FILE = 3
+BLOOM_HEADROOM = 2
+_growing = None
+
+async def _current_generation():
+    doc = await generations.find_one({'_id': 'files'})
+    return doc['n'] if doc else 0
+
+async def _bump_generation():
+    """Count a batch of writes that add file keys, before making them."""
+    global _own_writes
+    await generations.update_one({'_id': 'files'}, {'$inc': {'n': 1}}, upsert=True)
+    _own_writes += 1
+
+def _note_file_write():
+    """Count a single file write that added keys, together with the others made within the next second."""
+    global _pending_bump
+    if _pending_bump is None or _pending_bump.done():
+        _pending_bump = asyncio.create_task(_bump_later())
+
+async def _bump_later():
+    global _pending_bump
+    await asyncio.sleep(1)
+    # writes noted from now on need a bump of their own
+    _pending_bump = None
+    try:
+        await _bump_generation()
+    except Exception as e:
+        logger.warning(f"Could not count file writes in the known files generation: {e}")
+
+async def _shard_counts():
+    return [await Media.collection.estimated_document_count(), await Media2.collection.estimated_document_count()]
+
+async def load_known_files(rebuild=False):
+    """
+    Load the known file ids from the bloom snapshot, rebuilding it from both dbs when it is missing or stale.
+    rebuild=True skips the snapshot, for jobs that rewrote keys without changing the shard counts.
+    """
+    global known_files, _building_files, _generation, _own_writes
+    counts = await _shard_counts()
+    generation = await _current_generation()
+    bloom, meta = (None, {}) if rebuild else load_bloom(FILE_BLOOM_PATH)
+    if (bloom is not None and meta.get('generation') == generation and meta.get('counts') == counts
+            and meta.get('keys') == KNOWN_FILES_KEYS and len(bloom) <= bloom.capacity):
+        known_files = bloom
+        _generation, _own_writes = generation, 0
+        logger.info(f"Loaded {len(bloom)} known file ids from {FILE_BLOOM_PATH}")
+        return
+    # read before the scan, writes made during it leave the counter ahead of the snapshot
+    _generation, _own_writes = generation, 0
+    _building_files = BloomFilter(max(FILE_BLOOM_CAPACITY, KEYS_PER_FILE * BLOOM_HEADROOM * sum(counts)), FILE_BLOOM_ERROR_RATE)
+    try:
+        for collection in (Media.collection, Media2.collection):
+            async for doc in collection.find({}, {'_id': 1, 'file_unique_id': 1, 'fingerprint': 1}, batch_size=5000):
+                _building_files.add(doc['_id'])
+                if doc.get('file_unique_id'):
+                    _building_files.add(f"u:{doc['file_unique_id']}")
+                if doc.get('fingerprint'):
+                    _building_files.add(f"f:{doc['fingerprint']}")
+    except Exception:
+        _building_files = None
+        raise
+    known_files, _building_files = _building_files, None
+    logger.info(f"Rebuilt known file ids from both dbs ({len(known_files)} files)")
+    await save_known_files()
+
+async def save_known_files():
+    """Persist the known file ids so the next start can skip the rebuild."""
+    if known_files is None:
+        return
+    try:
+        generation = await _current_generation()
+        if _generation is None or generation != _generation + _own_writes:
+            # another process added files this one hasn't seen, the next start rebuilds
+            logger.info("Files were added to the dbs by another process, known file ids will be rebuilt on the next start")
+            generation = None
+        dump_bloom(known_files, FILE_BLOOM_PATH, {'counts': await _shard_counts(), 'keys': KNOWN_FILES_KEYS, 'generation': generation})
+    except Exception as e:
+        logger.warning(f"Could not save known file ids to {FILE_BLOOM_PATH}: {e}")
+
+def _remember_file(file_id, file_unique_id=None, fingerprint=None):
+    global _growing
+    for bloom in (known_files, _building_files):
+        if bloom is not None:
+            if file_id:
+                bloom.add(file_id)
+            if file_unique_id:
+                bloom.add(f"u:{file_unique_id}")
+            if fingerprint:
+                bloom.add(f"f:{fingerprint}")
+    # past its capacity the false positive rate climbs, rebuild it sized for the current catalog
+    if known_files is not None and len(known_files) > known_files.capacity and (_growing is None or _growing.done()):
+        _growing = asyncio.create_task(_grow_known_files())
+
+async def _grow_known_files():
+    logger.info(f"Known file ids are past their capacity ({len(known_files)} keys), rebuilding them bigger")
+    try:
+        await load_known_files(rebuild=True)
+    except Exception as e:
+        logger.exception(f"Could not rebuild the known file ids: {e}")
+
+async def is_file_saved(file_id):
+    """Check both dbs for file_id, skipping the round trips when the bloom filter has never seen it."""
+    if known_files is not None and file_id not in known_files:
+        return False
+    for collection in (Media.collection, Media2.collection):
+        if await collection.count_documents({'_id': file_id}, limit=1):
+            return True
+    return False
+
+def file_fingerprint(file_name, file_size, mime_type):
+    """Fingerprint of a file's normalized name, size and mime type, the same for every re-upload of it."""
+    name = re.sub(r"[^a-z0-9]+", " ", str(file_name).lower()).strip()
+    return hashlib.blake2b(f"{name}|{file_size}|{mime_type}".encode(), digest_size=16).hexdigest()
+
+async def merge_reupload(file_unique_id, fingerprint, caption=None):
+    """If the same file was uploaded before under another file_id, fill in what the stored copy is missing and return True."""
+    keys = []
+    if file_unique_id:
+        keys.append(('file_unique_id', file_unique_id, f"u:{file_unique_id}"))
+    keys.append(('fingerprint', fingerprint, f"f:{fingerprint}"))
+    if known_files is not None:
+        keys = [key for key in keys if key[2] in known_files]
+    if not keys:
+        return False
+    filter = {'$or': [{field: value} for field, value, _ in keys]}
+    for collection in (Media.collection, Media2.collection):
+        existing = await collection.find_one(filter, {'file_unique_id': 1, 'fingerprint': 1, 'caption': 1})
+        if not existing:
+            continue
+        missing = {}
+        if file_unique_id and not existing.get('file_unique_id'):
+            missing['file_unique_id'] = file_unique_id
+        if not existing.get('fingerprint'):
+            missing['fingerprint'] = fingerprint
+        if caption and not existing.get('caption'):
+            missing['caption'] = caption
+        if missing:
+            new_keys = 'file_unique_id' in missing or 'fingerprint' in missing
+            if new_keys:
+                _remember_file(existing['_id'], missing.get('file_unique_id'), missing.get('fingerprint'))
+            try:
+                await collection.update_one({'_id': existing['_id']}, {'$set': missing})
+            except DuplicateKeyError:
+                pass
+            else:
+                if new_keys:
+                    _note_file_write()
+        return True
+    return False
+
 async def save_file(media):
     """Save file in database"""
 
-    # TODO: Find better way to get same file_id for same media to avoid duplicates
     file_id, file_ref = unpack_new_file_id(media.file_id)
     file_name = re.sub(r"(_|\-|\.|\+)", " ", str(media.file_name))
+    # file_id changes with every re-upload, file_unique_id and the fingerprint don't
+    file_unique_id = getattr(media, 'file_unique_id', None)
+    fingerprint = file_fingerprint(file_name, media.file_size, media.mime_type)
+    caption = media.caption.html if media.caption else None
     try:
-        if await Media.count_documents({'file_id': file_id}, limit=1):
-            print(f'{getattr(media, "file_name", "NO_FILE")} is already saved in primary DB!')
+        if await is_file_saved(file_id):
+            print(f'{getattr(media, "file_name", "NO_FILE")} is already saved in database!')
+            return False, 0
+        if await merge_reupload(file_unique_id, fingerprint, caption):
+            print(f'{getattr(media, "file_name", "NO_FILE")} is a re-upload of a saved file!')
             return False, 0
+        extra = {'file_unique_id': file_unique_id} if file_unique_id else {}
+        extra.update(_source(media))
         file = saveMedia(
             file_id=file_id,
             file_ref=file_ref,
@@ -83,7 +362,9 @@ async def save_file(media):
             file_size=media.file_size,
             file_type=media.file_type,
             mime_type=media.mime_type,
-            caption=media.caption.html if media.caption else None,
+            caption=caption,
+            fingerprint=fingerprint,
+            **extra,
         )
     except ValidationError:
         print('Error occurred while saving file in database')
@@ -92,15 +373,138 @@ async def save_file(media):
         try:
             await file.commit()
         except DuplicateKeyError:  
+            _remember_file(file_id, file_unique_id, fingerprint)
             print(f'{getattr(media, "file_name", "NO_FILE")} is already saved in Selected database')
             return False, 0
         else:
+            _remember_file(file_id, file_unique_id, fingerprint)
+            _note_file_write()
+            file_routes.set(file_id, 0 if saveMedia is Media else 1)
             print(f'{getattr(media, "file_name", "NO_FILE")} is saved to Selected database')
             return True, 1
 
 
-async def get_search_results(chat_id, query, file_type=None, max_results=10, offset=0, filter=False):
-    """For given query return (results, next_offset)"""
+def _opt_str(value, field):
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"{field} should be a string, got {type(value).__name__}")
+    return value
+
+def _source(media):
+    """chat_id and message_id of the post a media came from, when the caller set them on it."""
+    return {field: getattr(media, field) for field in ('chat_id', 'message_id') if isinstance(getattr(media, field, None), int)}
+
+def media_to_doc(media):
+    """Build the raw Media/Media2 document for a pyrogram media object, raises ValueError when it can't be stored."""
+    file_id, file_ref = unpack_new_file_id(media.file_id)
+    file_size = media.file_size
+    if not isinstance(file_size, int) or isinstance(file_size, bool):
+        raise ValueError(f"file_size should be an integer, got {file_size!r}")
+    file_name = re.sub(r"(_|\-|\.|\+)", " ", str(media.file_name))
+    doc = {
+        '_id': file_id,
+        'file_ref': file_ref,
+        'file_name': file_name,
+        'file_size': file_size,
+        'file_type': _opt_str(media.file_type, 'file_type'),
+        'mime_type': _opt_str(media.mime_type, 'mime_type'),
+        'caption': media.caption.html if media.caption else None,
+        'fingerprint': file_fingerprint(file_name, file_size, media.mime_type),
+    }
+    file_unique_id = _opt_str(getattr(media, 'file_unique_id', None), 'file_unique_id')
+    if file_unique_id:
+        doc['file_unique_id'] = file_unique_id
+    doc.update(_source(media))
+    return doc
+
+def _doc_keys(doc):
+    keys = [doc['_id'], f"f:{doc['fingerprint']}"]
+    if doc.get('file_unique_id'):
+        keys.append(f"u:{doc['file_unique_id']}")
+    return keys
+
+async def _saved_keys(docs):
+    """Keys of `docs` (as in _doc_keys) that are already stored in either db, one query per db."""
+    if known_files is not None:
+        docs = [doc for doc in docs if any(key in known_files for key in _doc_keys(doc))]
+    if not docs:
+        return set()
+    filter = {'$or': [
+        {'_id': {'$in': [doc['_id'] for doc in docs]}},
+        {'fingerprint': {'$in': [doc['fingerprint'] for doc in docs]}},
+        {'file_unique_id': {'$in': [doc['file_unique_id'] for doc in docs if doc.get('file_unique_id')]}},
+    ]}
+    saved = set()
+    for collection in (Media.collection, Media2.collection):
+        async for found in collection.find(filter, {'_id': 1, 'fingerprint': 1, 'file_unique_id': 1}):
+            saved.add(found['_id'])
+            if found.get('fingerprint'):
+                saved.add(f"f:{found['fingerprint']}")
+            if found.get('file_unique_id'):
+                saved.add(f"u:{found['file_unique_id']}")
+    return saved
+
+async def save_files(medias):
+    """
+    Save a batch of files with one duplicate probe per db and a single unordered insert_many.
+    Returns one (saved, status) pair per media, with the same status codes as save_file:
+    1 saved, 0 duplicate (also re-uploads and repeats within the batch), 2 error.
+    """
+    results = [(False, 2)] * len(medias)
+    docs, positions = [], []
+    for i, media in enumerate(medias):
+        try:
+            docs.append(media_to_doc(media))
+            positions.append(i)
+        except Exception as e:
+            logger.warning(f"Skipping {getattr(media, 'file_name', 'NO_FILE')}: {e}")
+    for i, result in zip(positions, await insert_docs(docs, saveMedia)):
+        results[i] = result
+    return results
+
+async def insert_docs(docs, document):
+    """
+    Insert raw file documents (with fingerprints) into `document` (Media or Media2), skipping
+    the ones already stored in either db. Returns one (saved, status) pair per doc like save_files.
+    """
+    results = [(False, 0)] * len(docs)
+    saved = await _saved_keys(docs)
+    batch, positions = [], []
+    for i, doc in enumerate(docs):
+        keys = _doc_keys(doc)
+        if any(key in saved for key in keys):
+            continue
+        saved.update(keys)
+        batch.append(doc)
+        positions.append(i)
+        results[i] = (True, 1)
+    if not batch:
+        return results
+
+    await _bump_generation()
+    collection = document.collection.with_options(write_concern=WriteConcern(w=INDEX_WRITE_CONCERN))
+    try:
+        await collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            i = positions[error['index']]
+            results[i] = (False, 0) if error.get('code') == 11000 else (False, 2)
+            if error.get('code') != 11000:
+                logger.warning(f"Could not save {batch[error['index']]['file_name']}: {error.get('errmsg')}")
+    shard = 0 if document is Media else 1
+    for doc, i in zip(batch, positions):
+        if results[i][1] != 2:
+            _remember_file(doc['_id'], doc.get('file_unique_id'), doc['fingerprint'])
+        if results[i][0]:
+            file_routes.set(doc['_id'], shard)
+    return results
+
+
+async def get_search_results(chat_id, query, file_type=None, max_results=10, offset=0, filter=False, budget_ms=SEARCH_BUDGET_GROUP_MS):
+    """
+    For given query return (results, next_offset, total_results).
+    The whole search gets `budget_ms` ms (0 = no limit), a db that doesn't answer in time is left out
+    and results.partial is set.
+    """
     if chat_id is not None:
         settings = await get_settings(int(chat_id))
         max_results = 10  # Default max results
@@ -131,32 +535,45 @@ async def get_search_results(chat_id, query, file_type=None, max_results=10, off
     if file_type:
         filter['file_type'] = file_type
 
-    total_results = ((await Media.count_documents(filter))+(await Media2.count_documents(filter)))
+    deadline = time.monotonic() + budget_ms / 1000 if budget_ms else None
+    collection, collection2 = search_collection(Media), search_collection(Media2)
+    left = _time_left(deadline)
+    count_options = {'maxTimeMS': left} if left else {}
+    (total1, ok1), (total2, ok2) = await asyncio.gather(
+        on_shard(0, lambda: collection.count_documents(filter, **count_options), 0, left),
+        on_shard(1, lambda: collection2.count_documents(filter, **count_options), 0, left),
+    )
+    total_results = total1 + total2
 
     # Ensures `max_results` is an even number
     if max_results % 2 != 0:  # If `max_results` is odd, add 1 to make it even
         logger.info(f"Since max_results is an odd number ({max_results}), bot will use {max_results+1} as max_results to make it even.")
         max_results += 1
 
-    cursor = Media.find(filter)
-    cursor2 = Media2.find(filter)
-    # Sort by recent
-    cursor.sort('$natural', -1)
-    cursor2.sort('$natural', -1)
-    # Slice files according to offset and max results
-    cursor2.skip(offset).limit(max_results)
-    # Get list of files
-    fileList2 = await cursor2.to_list(length=max_results)
+    # raw cursors with a projection, results are FileRecords instead of umongo documents
+    # Sort by recent, slice files according to offset and max results
+    fileList2 = []
+    if ok2:
+        left = _time_left(deadline)
+        cursor2 = collection2.find(filter, FILE_PROJECTION).sort('$natural', -1).skip(offset).limit(max_results).max_time_ms(left)
+        docs, ok2 = await on_shard(1, lambda: cursor2.to_list(length=max_results), [], left)
+        fileList2 = _cache_records(docs, 1, CACHE_SEARCH_RESULTS)
     if len(fileList2) < max_results:
         next_offset = offset + len(fileList2)
-        cursorSkipper = (next_offset - (await Media2.count_documents(filter)))
-        cursor.skip(cursorSkipper if cursorSkipper >= 0 else 0).limit(max_results - len(fileList2))
-        fileList1 = await cursor.to_list(length=(max_results - len(fileList2)))
-        files = fileList2 + fileList1
+        fileList1 = []
+        if ok1:
+            cursorSkipper = (next_offset - total2)
+            left = _time_left(deadline)
+            cursor = collection.find(filter, FILE_PROJECTION).sort('$natural', -1).max_time_ms(left)
+            cursor.skip(cursorSkipper if cursorSkipper >= 0 else 0).limit(max_results - len(fileList2))
+            docs, ok1 = await on_shard(0, lambda: cursor.to_list(length=(max_results - len(fileList2))), [], left)
+            fileList1 = _cache_records(docs, 0, CACHE_SEARCH_RESULTS)
+        files = ShardResults(fileList2 + fileList1)
         next_offset = next_offset + len(fileList1)
     else:
-        files = fileList2
+        files = ShardResults(fileList2)
         next_offset = offset + max_results
+    files.partial = not (ok1 and ok2)
     if next_offset >= total_results:
         next_offset = ''
     return files, next_offset, total_results
@@ -202,14 +619,89 @@ async def get_bad_files(query, file_type=None, filter=False):
 
     return files, total_results
 
+def _cache_records(docs, shard, cache=True):
+    """
+    FileRecords for docs read from db `shard`, cached since the next request is usually for one of them.
+    Only pass `cache` for docs read from the primary, or a stale read could cache a file after forget_file.
+    """
+    records = [FileRecord(doc) for doc in docs]
+    if cache:
+        for record in records:
+            file_cache.set(record.file_id, record)
+            file_routes.set(record.file_id, shard)
+    return records
+
+def forget_file(file_id=None):
+    """Drop a deleted file from the file cache and routing map, or everything when file_id is None."""
+    if file_id is None:
+        file_cache.clear()
+        file_routes.clear()
+    else:
+        file_cache.pop(file_id)
+        file_routes.pop(file_id)
+
+def _posts_filter(posts):
+    by_chat = {}
+    for chat_id, message_id in posts:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    return {'$or': [{'chat_id': chat_id, 'message_id': {'$in': ids}} for chat_id, ids in by_chat.items()]}
+
+async def find_posts(posts):
+    """The stored files of (chat_id, message_id) posts, as {(chat_id, message_id): (shard, doc)}."""
+    found = {}
+    if not posts:
+        return found
+    for shard, document in enumerate((Media, Media2)):
+        async for doc in document.collection.find(_posts_filter(posts), {'chat_id': 1, 'message_id': 1, 'file_unique_id': 1}):
+            found[(doc['chat_id'], doc['message_id'])] = (shard, doc)
+    return found
+
+async def delete_posts(posts):
+    """Delete the files of (chat_id, message_id) posts from whichever db holds them, one delete per db. Returns how many."""
+    found = await find_posts(posts)
+    deleted = 0
+    for shard, document in enumerate((Media, Media2)):
+        ids = [doc['_id'] for s, doc in found.values() if s == shard]
+        if ids:
+            deleted += (await document.collection.delete_many({'_id': {'$in': ids}})).deleted_count
+            for file_id in ids:
+                forget_file(file_id)
+    return deleted
+
+async def update_captions(updates):
+    """Set new captions, `updates` being (shard, file_id, caption html) tuples. One bulk write per db."""
+    for shard, document in enumerate((Media, Media2)):
+        ops = [UpdateOne({'_id': file_id}, {'$set': {'caption': caption}}) for s, file_id, caption in updates if s == shard]
+        if ops:
+            await document.collection.bulk_write(ops, ordered=False)
+    for _, file_id, _ in updates:
+        forget_file(file_id)
+
 async def get_file_details(query):
-    filter = {'file_id': query}
-    cursor = Media.find(filter)
-    filedetails = await cursor.to_list(length=1)
-    if not filedetails:
-        cursor2 = Media2.find(filter)
-        filedetails = await cursor2.to_list(length=1)
-    return filedetails
+    """ShardResults with the FileRecord of file_id `query`, empty and `partial` when a db that may hold it was skipped."""
+    files = ShardResults()
+    record = file_cache.get(query)
+    if record is not None:
+        files.append(record)
+        return files
+    shard = file_routes.get(query)
+    for shard in ((0, 1) if shard is None else (shard, 1 - shard)):
+        doc, ok = await on_shard(shard, lambda: (Media, Media2)[shard].collection.find_one({'_id': query}, FILE_PROJECTION))
+        if doc:
+            files.extend(_cache_records([doc], shard))
+            files.partial = False
+            return files
+        files.partial = files.partial or not ok
+    return files
+
+async def shard_stats():
+    """(files, used MB) of Media and Media2 for /stats, None for a db that is skipped or not answering."""
+    async def read(document, database):
+        count = await document.collection.estimated_document_count()
+        stats = await database.command('dbStats')
+        return count, (stats['dataSize'] + stats['indexSize']) / (1024 * 1024)
+    results = await asyncio.gather(on_shard(0, lambda: read(Media, db)), on_shard(1, lambda: read(Media2, db2)))
+    return [result for result, _ in results]
 
 def encode_file_id(s: bytes) -> str:
     r = b""
@@ -0,0 +1,63 @@
+from datetime import datetime
+from bson import ObjectId
+from info import DATABASE_URI, DATABASE_NAME
+from database.clients import get_client
+
+#one document per indexing run: what is indexed, how far it got and where its progress message is
+jobs = get_client(DATABASE_URI)[DATABASE_NAME].index_jobs
+#highest message id indexed per chat, catch-up indexing starts after it
+high_water = get_client(DATABASE_URI)[DATABASE_NAME].index_high_water
+
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = 'queued', 'running', 'done', 'cancelled', 'failed'
+
+
+async def create_job(chat, last_id, first_id, msg_chat_id=None, msg_id=None, status=RUNNING):
+    job = {
+        '_id': str(ObjectId()),
+        'chat': chat,
+        'last_id': last_id,
+        'first_id': first_id,
+        'position': None,
+        'stats': {},
+        'status': status,
+        'msg_chat_id': msg_chat_id,
+        'msg_id': msg_id,
+        'started': datetime.utcnow(),
+        'updated': datetime.utcnow(),
+    }
+    await jobs.insert_one(job)
+    return job
+
+
+async def set_status(job_id, status):
+    await jobs.update_one({'_id': job_id}, {'$set': {'status': status, 'updated': datetime.utcnow()}})
+
+
+async def save_checkpoint(job_id, position, stats):
+    """Remember that everything above message `position` is saved, with the counters so far."""
+    await jobs.update_one({'_id': job_id}, {'$set': {'position': position, 'stats': stats, 'updated': datetime.utcnow()}})
+
+
+async def finish_job(job_id, status, position, stats):
+    await jobs.update_one({'_id': job_id}, {'$set': {'status': status, 'position': position, 'stats': stats, 'updated': datetime.utcnow()}})
+
+
+async def get_job(job_id):
+    return await jobs.find_one({'_id': job_id})
+
+
+async def interrupted_jobs():
+    """Jobs still queued or running, i.e. stopped by a restart or crash, oldest first."""
+    return await jobs.find({'status': {'$in': [QUEUED, RUNNING]}}).sort('started', 1).to_list(length=None)
+
+
+async def get_high_water(chat_id):
+    doc = await high_water.find_one({'_id': chat_id})
+    return doc['message_id'] if doc else None
+
+
+async def set_high_water(chat_id, message_id):
+    """Raise the high-water mark of `chat_id` to `message_id`, it never goes down."""
+    await high_water.update_one(
+        {'_id': chat_id}, {'$max': {'message_id': message_id}, '$set': {'updated': datetime.utcnow()}}, upsert=True
+    )
@@ -0,0 +1,129 @@
+"""
+Micro-batching of writes that arrive one at a time, like channel posts.
+
+Items put on an IngestQueue are handed to its flush coroutine in batches, as soon as
+`batch_size` of them are waiting or `max_delay` seconds after the first one came in,
+so a burst of uploads becomes a few batched writes instead of a round trip per file.
+A flush failing with a transient MongoDB error is retried with exponential backoff,
+anything else (or running out of retries) drops the batch with an error in the log.
+"""
+import time
+import asyncio
+import logging
+from pymongo.errors import AutoReconnect, ExecutionTimeout, WTimeoutError
+from info import INGEST_BATCH_SIZE, INGEST_FLUSH_SECS, INGEST_RETRIES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#AutoReconnect covers network errors, timeouts and primary elections
+TRANSIENT_ERRORS = (AutoReconnect, ExecutionTimeout, WTimeoutError)
+MAX_BACKOFF = 30    # seconds
+#every queue, for /dbstatus and for draining on stop
+QUEUES = []
+
+
+class IngestQueue:
+    def __init__(self, name, flush, batch_size=INGEST_BATCH_SIZE, max_delay=INGEST_FLUSH_SECS, retries=INGEST_RETRIES, on_drop=None):
+        self.name = name
+        self.flush = flush
+        # called with a batch that is given up on
+        self.on_drop = on_drop
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retries = retries
+        # put() waits while this many items are waiting, so a stuck db doesn't grow it forever
+        self.max_depth = batch_size * 20
+        self.items = []
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._task = None
+        self._flushing = 0
+        self.flushed = 0
+        self.batches = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latency_ms = 0.0
+        QUEUES.append(self)
+
+    async def put(self, item):
+        while len(self.items) >= self.max_depth:
+            self._drained.clear()
+            await self._drained.wait()
+        self.items.append(item)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if len(self.items) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while self.items:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self.items:
+                batch, self.items = self.items[:self.batch_size], self.items[self.batch_size:]
+                self._drained.set()
+                await self._flush(batch)
+                if len(self.items) < self.batch_size:
+                    break
+
+    async def _flush(self, batch):
+        self._flushing = len(batch)
+        try:
+            for attempt in range(self.retries + 1):
+                start = time.monotonic()
+                try:
+                    await self.flush(batch)
+                except TRANSIENT_ERRORS as e:
+                    if attempt == self.retries:
+                        self._drop(batch)
+                        logger.error(f"{self.name}: dropped {len(batch)} items after {attempt + 1} tries: {e}")
+                        return
+                    self.retried += 1
+                    delay = min(MAX_BACKOFF, 0.5 * 2 ** attempt)
+                    logger.warning(f"{self.name}: flush of {len(batch)} items failed ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    self._drop(batch)
+                    logger.exception(f"{self.name}: dropped {len(batch)} items: {e}")
+                    return
+                else:
+                    latency = (time.monotonic() - start) * 1000
+                    self.latency_ms = latency if not self.batches else 0.8 * self.latency_ms + 0.2 * latency
+                    self.batches += 1
+                    self.flushed += len(batch)
+                    return
+        finally:
+            self._flushing = 0
+
+    def _drop(self, batch):
+        self.dropped += len(batch)
+        if self.on_drop:
+            self.on_drop(batch)
+
+    async def drain(self):
+        """Flush everything waiting now, on stop."""
+        while self.items:
+            batch, self.items = self.items[:self.batch_size], self.items[self.batch_size:]
+            await self._flush(batch)
+
+    def stats(self):
+        return {
+            'depth': len(self.items) + self._flushing,
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'latency_ms': round(self.latency_ms),
+        }
+
+
+async def drain_queues():
+    for queue in QUEUES:
+        try:
+            await queue.drain()
+        except Exception as e:
+            logger.exception(f"Could not drain {queue.name}: {e}")
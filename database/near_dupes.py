@@ -0,0 +1,143 @@
+import re
+import zlib
+import logging
+import numpy as np
+from database.ia_filterdb import Media, Media2, get_bad_files, forget_file, search_collection
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SHINGLE = 4              # characters per shingle of the squashed title
+NUM_PERM = 64            # minhash permutations per title
+CHUNK = 500              # titles hashed per numpy batch, bounds the (NUM_PERM x shingles) matrix
+PRIME = np.uint64((1 << 31) - 1)
+
+
+def _squash(title):
+    """Lowercase alphanumerics only, so 'HD Rip' and 'HDRip' shingle the same."""
+    return re.sub(r"[^a-z0-9]", "", str(title).lower())
+
+
+def _numbers(title):
+    """Year, resolution, season/episode... two titles that differ here are different files."""
+    return re.findall(r"\d+", str(title))
+
+
+def shingles(title):
+    s = _squash(title)
+    if len(s) <= SHINGLE:
+        return {s} if s else set()
+    return {s[i:i + SHINGLE] for i in range(len(s) - SHINGLE + 1)}
+
+
+def similarity(title1, title2):
+    """Jaccard similarity of the title shingles, 0 when the numbers in the titles differ."""
+    if _numbers(title1) != _numbers(title2):
+        return 0.0
+    s1, s2 = shingles(title1), shingles(title2)
+    if not s1 or not s2:
+        return 0.0
+    return len(s1 & s2) / len(s1 | s2)
+
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+    """(bands, rows) whose LSH threshold (1/bands)^(1/rows) is closest to `threshold`."""
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda o: abs((1 / o[0]) ** (1 / o[1]) - threshold))
+
+
+def band_hashes(titles, bands, num_perm=NUM_PERM, seed=7):
+    """
+    MinHash every title and fold each band of its signature into one uint64.
+    Returns a (len(titles), bands) array, titles sharing a value in any column are LSH candidates.
+    Every title must have at least one shingle.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)[:, None]
+    b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+    mix = rng.integers(1, 1 << 63, num_perm // bands, dtype=np.uint64) | np.uint64(1)
+    out = np.empty((len(titles), bands), dtype=np.uint64)
+    for start in range(0, len(titles), CHUNK):
+        hashed = [
+            np.fromiter((zlib.crc32(s.encode()) & 0x7fffffff for s in shingles(t)), dtype=np.uint64)
+            for t in titles[start:start + CHUNK]
+        ]
+        offsets = np.cumsum([0] + [len(h) for h in hashed[:-1]])
+        x = np.concatenate(hashed)[None, :]
+        # signature = min over shingles of (a*x + b) mod p, for every permutation at once
+        sig = np.minimum.reduceat((a * x + b) % PRIME, offsets, axis=1).T
+        sig = sig.reshape(len(hashed), bands, -1)
+        out[start:start + len(hashed)] = (sig * mix).sum(axis=2)
+    return out
+
+
+def cluster_titles(titles, threshold=0.7):
+    """Group near-duplicate titles, returns lists of indices into `titles` with 2+ members."""
+    keep = [i for i, t in enumerate(titles) if shingles(t)]
+    if len(keep) < 2:
+        return []
+    bands, _ = lsh_params(threshold)
+    hashes = band_hashes([titles[i] for i in keep], bands)
+    parent = list(range(len(keep)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for column in hashes.T:
+        order = np.argsort(column, kind='stable')
+        ordered = column[order]
+        starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+        ends = np.r_[starts[1:], len(ordered)]
+        for start, end in zip(starts, ends):
+            if end - start < 2:
+                continue
+            leader = order[start]
+            for j in order[start + 1:end]:
+                ra, rb = find(leader), find(j)
+                if ra != rb and similarity(titles[keep[leader]], titles[keep[j]]) >= threshold:
+                    parent[rb] = ra
+
+    clusters = {}
+    for i in range(len(keep)):
+        clusters.setdefault(find(i), []).append(keep[i])
+    return [c for c in clusters.values() if len(c) > 1]
+
+
+async def load_entries(query=None):
+    """(shard, _id, file_name, file_size) of every file, or of the files get_bad_files finds for `query`."""
+    if query:
+        found = await get_bad_files(query)
+        files = found[0] if found else []
+        return [(1 if isinstance(f, Media2) else 0, f.file_id, f.file_name, f.file_size) for f in files]
+    entries = []
+    # a full scan, so it reads from the search members and leaves the primary to the writes
+    for shard, collection in enumerate((search_collection(Media), search_collection(Media2))):
+        async for doc in collection.find({}, {'file_name': 1, 'file_size': 1}, batch_size=5000):
+            entries.append((shard, doc['_id'], doc.get('file_name') or '', doc.get('file_size') or 0))
+    return entries
+
+
+async def find_near_duplicates(threshold=0.7, query=None):
+    """Near-duplicate clusters across Media/Media2, each a list of (shard, _id, file_name, file_size), largest file first."""
+    entries = await load_entries(query)
+    clusters = cluster_titles([e[2] for e in entries], threshold)
+    logger.info(f"Found {len(clusters)} near-duplicate clusters in {len(entries)} files")
+    return [sorted((entries[i] for i in c), key=lambda e: e[3], reverse=True) for c in clusters]
+
+
+async def purge_near_duplicates(clusters, batch_size=500):
+    """Delete every file of each cluster except its first (largest) one, returns the number deleted."""
+    to_delete = {0: [], 1: []}
+    for cluster in clusters:
+        for shard, file_id, _, _ in cluster[1:]:
+            to_delete[shard].append(file_id)
+            forget_file(file_id)
+    removed = 0
+    for shard, collection in enumerate((Media.collection, Media2.collection)):
+        ids = to_delete[shard]
+        for i in range(0, len(ids), batch_size):
+            removed += (await collection.delete_many({'_id': {'$in': ids[i:i + batch_size]}})).deleted_count
+    return removed
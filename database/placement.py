@@ -0,0 +1,241 @@
+"""
+Which cluster (primary = DATABASE_URI, second = SECONDDB_URI) holds each of the small, hot
+collections, so they can be kept away from the one that file indexing is filling up.
+
+COLLECTION_PLACEMENT, e.g. "users=second,groups=second", only sets where a collection starts out:
+on the first start the placement of each collection is stored in the primary db, on the cluster
+already holding its documents if any, and from then on only /migrate moves it.
+"""
+import re
+import bson
+import hashlib
+import logging
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from info import DATABASE_URI, SECONDDB_URI, DATABASE_NAME, COLLECTION_PLACEMENT
+from database.clients import get_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CLUSTERS = ('primary', 'second')
+#logical collection -> collection name, None for filters which have one collection per group named after its id
+COLLECTIONS = {'users': 'users', 'groups': 'groups', 'connections': 'CONNECTION', 'filters': None}
+FILTER_COLLECTION = re.compile(r'^-?\d+$')
+
+
+def _parse(value):
+    placement = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, cluster = item.partition('=')
+        name, cluster = name.strip().lower(), cluster.strip().lower()
+        if name not in COLLECTIONS or cluster not in CLUSTERS:
+            logger.warning(f"Ignoring COLLECTION_PLACEMENT entry {item!r}")
+            continue
+        placement[name] = cluster
+    return placement
+
+
+configured = _parse(COLLECTION_PLACEMENT)
+placement = {name: 'primary' for name in COLLECTIONS}
+placement.update(configured)
+
+
+def cluster_db(cluster):
+    """The bot's database on `cluster`, the primary one when there is no SECONDDB_URI."""
+    return get_client(SECONDDB_URI if cluster == 'second' and SECONDDB_URI else DATABASE_URI)[DATABASE_NAME]
+
+
+def database(name):
+    """Database holding the logical collection `name`."""
+    return cluster_db(placement[name])
+
+
+def collection(name):
+    return database(name)[COLLECTIONS[name]]
+
+
+def other_collection(name):
+    """The same collection on the other cluster, where older documents may still be."""
+    return cluster_db('second' if placement[name] == 'primary' else 'primary')[COLLECTIONS[name]]
+
+
+#placements stored by /migrate
+stored = cluster_db('primary').placement
+
+
+async def _has_documents(db, names):
+    for n in names:
+        if await db[n].find_one({}, {'_id': 1}):
+            return True
+    return False
+
+
+async def _clusters_holding(name):
+    """Clusters with documents of the logical collection `name`."""
+    clusters = []
+    for cluster in CLUSTERS:
+        if cluster == 'second' and not SECONDDB_URI:
+            continue
+        db = cluster_db(cluster)
+        if await _has_documents(db, await _names(name, db)):
+            clusters.append(cluster)
+    return clusters
+
+
+async def load_placement():
+    """
+    Apply the stored placements, on bot start. A collection without one is placed on the cluster
+    holding its documents, or where COLLECTION_PLACEMENT puts it when it has none yet, and stored.
+    """
+    doc = await stored.find_one({'_id': 'placement'}) or {}
+    new = {}
+    for name in COLLECTIONS:
+        if doc.get(name) in CLUSTERS:
+            placement[name] = doc[name]
+            if name in configured and configured[name] != doc[name]:
+                logger.warning(f"COLLECTION_PLACEMENT puts {name} on the {configured[name]} cluster but it is on the {doc[name]} one, "
+                               f"move it with /migrate {name} {configured[name]}")
+            continue
+        held = await _clusters_holding(name)
+        if held and placement[name] not in held:
+            logger.warning(f"The documents of {name} are on the {held[0]} cluster, keeping it there instead of the "
+                           f"{placement[name]} one, move it with /migrate {name} {placement[name]}")
+            placement[name] = held[0]
+        new[name] = placement[name]
+    if new:
+        await stored.update_one({'_id': 'placement'}, {'$set': new}, upsert=True)
+    if 'second' in placement.values() and not SECONDDB_URI:
+        logger.warning("Some collections are placed on the second cluster but SECONDDB_URI is not set, using the primary")
+    logger.info(f"Collection placement: {placement}")
+
+
+async def _names(name, db):
+    if COLLECTIONS[name] is not None:
+        return [COLLECTIONS[name]]
+    return [n for n in await db.list_collection_names() if FILTER_COLLECTION.match(n)]
+
+
+async def placement_report():
+    """
+    ({cluster: used MB}, [(name, cluster, documents, MB)]) for /placement.
+    Used MB is data + indexes, like /stats.
+    """
+    clusters = {}
+    for cluster in CLUSTERS:
+        if cluster == 'second' and not SECONDDB_URI:
+            continue
+        stats = await cluster_db(cluster).command('dbStats')
+        clusters[cluster] = (stats['dataSize'] + stats['indexSize']) / (1024 * 1024)
+    rows = []
+    for name in COLLECTIONS:
+        db = database(name)
+        count = size = 0
+        for n in await _names(name, db):
+            try:
+                stats = await db.command('collStats', n)
+            except Exception:
+                continue  # not created yet
+            count += stats.get('count', 0)
+            size += stats.get('size', 0) + stats.get('totalIndexSize', 0)
+        rows.append((name, placement[name], count, size / (1024 * 1024)))
+    return clusters, rows
+
+
+async def _copy(col, ops):
+    try:
+        await col.bulk_write(ops, ordered=False)
+        return len(ops)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        logger.warning(f"{len(errors)} documents were not copied to {col.name}: {errors[0].get('errmsg') if errors else ''}")
+        return len(ops) - len(errors)
+
+
+def _digest(doc):
+    return hashlib.blake2b(bson.encode(doc), digest_size=8).digest()
+
+
+async def _copy_all(source, target, names, batch_size, progress):
+    """First pass: copy every document. Returns (copied, {name: {_id: digest}}) of the copies, for _replay."""
+    copied, seen = 0, {}
+    for n in names:
+        digests = seen[n] = {}
+        ops = []
+        async for doc in source[n].find({}, batch_size=batch_size):
+            digests[doc['_id']] = _digest(doc)
+            ops.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+            if len(ops) >= batch_size:
+                copied += await _copy(target[n], ops)
+                ops = []
+                if progress:
+                    await progress(copied)
+        if ops:
+            copied += await _copy(target[n], ops)
+    return copied, seen
+
+
+async def _replay(source, target, names, seen, batch_size):
+    """
+    Second pass, after the switch: apply what was inserted, updated or deleted on the source between
+    its first pass copy and the switch. A copied document is only replaced or deleted while the target
+    still holds the first pass copy of it, so what the bot changed or deleted there since the switch wins.
+    """
+    for n in names:
+        digests = seen[n]
+        #_id -> (digest of the first pass copy or None, source document or None)
+        changed = {}
+        async for doc in source[n].find({}, batch_size=batch_size):
+            before = digests.pop(doc['_id'], None)
+            if before is None or before != _digest(doc):
+                changed[doc['_id']] = (before, doc)
+        # what is left was deleted from the source after it was copied
+        for _id, before in digests.items():
+            changed[_id] = (before, None)
+        ids = list(changed)
+        for i in range(0, len(ids), batch_size):
+            chunk = ids[i:i + batch_size]
+            current = {doc['_id']: _digest(doc) async for doc in target[n].find({'_id': {'$in': chunk}})}
+            ops = []
+            for _id in chunk:
+                before, doc = changed[_id]
+                if before is None:
+                    # new on the source, unless the bot created it on the target meanwhile
+                    if _id not in current:
+                        ops.append(UpdateOne({'_id': doc.pop('_id')}, {'$setOnInsert': doc}, upsert=True))
+                elif current.get(_id) != before:
+                    continue
+                elif doc is None:
+                    ops.append(DeleteOne({'_id': _id}))
+                else:
+                    ops.append(ReplaceOne({'_id': _id}, doc))
+            if ops:
+                await _copy(target[n], ops)
+        if changed:
+            logger.info(f"Replayed {len(changed)} documents of {n} changed during the copy")
+
+
+async def migrate(name, cluster, batch_size=500, progress=None):
+    """
+    Move the logical collection `name` to `cluster`: copy it, switch reads and writes to the copy,
+    replay what was written to the old one meanwhile, then drop the old one.
+    `progress` is an optional coroutine called with the number of documents copied. Returns that number.
+    """
+    if cluster == 'second' and not SECONDDB_URI:
+        raise ValueError("SECONDDB_URI is not set")
+    # moved from wherever documents are left, not from where `placement` says, so a placement that
+    # got out of step with the data can still be fixed
+    source, target = cluster_db('second' if cluster == 'primary' else 'primary'), cluster_db(cluster)
+    names = await _names(name, source) if SECONDDB_URI else []
+    if not await _has_documents(source, names):
+        placement[name] = cluster
+        await stored.update_one({'_id': 'placement'}, {'$set': {name: cluster}}, upsert=True)
+        return 0
+    copied, seen = await _copy_all(source, target, names, batch_size, progress)
+    placement[name] = cluster
+    await stored.update_one({'_id': 'placement'}, {'$set': {name: cluster}}, upsert=True)
+    await _replay(source, target, names, seen, batch_size)
+    for n in names:
+        await source[n].drop()
+    logger.info(f"Moved {name} ({copied} documents in {len(names)} collections) to the {cluster} cluster")
+    return copied
@@ -0,0 +1,92 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class ShardHealth:
+    """
+    Latency/error tracking and a circuit breaker for one files db.
+    After `failure_threshold` failed calls in a row, or once the latency EWMA goes over `slow_ms` (0 = never),
+    the breaker opens and the shard is skipped for `cooldown` seconds. Then one call is let
+    through as a probe (half-open): success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=3, cooldown=30, slow_ms=2000, alpha=0.2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_ms = slow_ms
+        self.alpha = alpha
+        self.state = CLOSED
+        self.latency_ms = 0.0      # EWMA of call latency
+        self.error_rate = 0.0      # EWMA of failed calls (0..1)
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.trips = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+
+    def allow(self):
+        """Whether a call may go to this shard now."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self._probe_at = 0.0
+        # one probe at a time, another one if the last probe never reported back
+        if self.state == HALF_OPEN and now - self._probe_at >= self.cooldown:
+            self._probe_at = now
+            return True
+        return False
+
+    def _observe(self, latency_ms, failed):
+        self.calls += 1
+        if not self.latency_ms:
+            self.latency_ms = latency_ms
+        self.latency_ms += self.alpha * (latency_ms - self.latency_ms)
+        self.error_rate += self.alpha * (failed - self.error_rate)
+
+    def success(self, latency_ms):
+        self._observe(latency_ms, 0)
+        self.consecutive_failures = 0
+        if self.state == HALF_OPEN:
+            # the probe answered, judge it on its own latency instead of the history that tripped the breaker
+            self.latency_ms = latency_ms
+        if self.slow_ms and self.latency_ms > self.slow_ms:
+            self._open(f"latency {self.latency_ms:.0f}ms over {self.slow_ms}ms")
+        elif self.state == HALF_OPEN:
+            self._close()
+
+    def failure(self, latency_ms, error=None):
+        self._observe(latency_ms, 1)
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open(f"{self.consecutive_failures} failures in a row, last: {error}")
+
+    def _open(self, reason):
+        if self.state != OPEN:
+            self.trips += 1
+            logger.warning(f"{self.name} is not healthy ({reason}), skipping it for {self.cooldown}s")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+
+    def _close(self):
+        logger.info(f"{self.name} is answering again")
+        self.state = CLOSED
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'latency_ms': round(self.latency_ms, 1),
+            'error_rate': round(self.error_rate, 3),
+            'calls': self.calls,
+            'errors': self.errors,
+            'trips': self.trips,
+        }
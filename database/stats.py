@@ -0,0 +1,20 @@
+from Script import script
+from database.users_chats_db import db
+from database.ia_filterdb import shard_stats
+
+
+async def stats_text():
+    """STATUS_TXT filled in, a files db that is not answering is shown as unavailable."""
+    shards = await shard_stats()
+    # users and chats
+    users = await db.total_users_count()
+    chats = await db.total_chat_count()
+    values = []
+    for shard in shards:
+        if shard is None:
+            values += ['unavailable', '-', '-']
+        else:
+            total, used_dbSize = shard
+            values += [total, round(used_dbSize, 2), round(512 - used_dbSize, 2)]
+    total_files = sum(shard[0] for shard in shards if shard is not None)
+    return script.STATUS_TXT.format(total_files, users, chats, *values)
@@ -1,14 +1,52 @@
 # https://github.com/odysseusmax/animated-lamp/blob/master/bot/database/database.py
-import motor.motor_asyncio
+import logging
+from database.clients import get_client
+from database import placement
 from info import DATABASE_NAME, DATABASE_URI, IMDB, IMDB_TEMPLATE, MELCOW_NEW_USERS, P_TTI_SHOW_OFF, SINGLE_BUTTON, SPELL_CHECK_REPLY, PROTECT_CONTENT
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
 class Database:
     
     def __init__(self, uri, database_name):
-        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self._client = get_client(uri)
         self.db = self._client[database_name]
-        self.col = self.db.users
-        self.grp = self.db.groups
+
+    # users and groups live on the cluster COLLECTION_PLACEMENT / /migrate put them on
+    @property
+    def col(self):
+        return placement.collection('users')
+
+    @property
+    def grp(self):
+        return placement.collection('groups')
+
+
+    async def ensure_indexes(self):
+        """Unique index on id for users and groups, so lookups don't scan and duplicates can't be inserted."""
+        for col in (self.col, self.grp):
+            index = (await col.index_information()).get('id_1')
+            if index and index.get('unique'):
+                continue
+            removed = await self._drop_duplicates(col)
+            if index:
+                await col.drop_index('id_1')
+            await col.create_index('id', unique=True)
+            logger.info(f"Created unique id index on {col.name}, removed {removed} duplicate documents")
+
+
+    async def _drop_duplicates(self, col):
+        """Keep one document per id (banned/disabled or with settings first, then the oldest) and delete the rest."""
+        removed = 0
+        pipeline = [
+            {'$sort': {'ban_status.is_banned': -1, 'chat_status.is_disabled': -1, 'settings': -1, '_id': 1}},
+            {'$group': {'_id': '$id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        async for group in col.aggregate(pipeline, allowDiskUse=True):
+            removed += (await col.delete_many({'_id': {'$in': group['ids'][1:]}})).deleted_count
+        return removed
 
 
     def new_user(self, id, name):
@@ -33,8 +71,11 @@ class Database:
         )
     
     async def add_user(self, id, name):
-        user = self.new_user(id, name)
-        await self.col.insert_one(user)
+        """Insert the user unless it exists, in one round trip. Returns True for a new user."""
+        user = self.new_user(int(id), name)
+        del user['id']
+        result = await self.col.update_one({'id': int(id)}, {'$setOnInsert': user}, upsert=True)
+        return result.upserted_id is not None
     
     async def is_user_exist(self, id):
         user = await self.col.find_one({'id':int(id)})
@@ -86,8 +127,11 @@ class Database:
 
 
     async def add_chat(self, chat, title):
-        chat = self.new_group(chat, title)
-        await self.grp.insert_one(chat)
+        """Insert the chat unless it exists, in one round trip. Returns True for a new chat."""
+        group = self.new_group(int(chat), title)
+        del group['id']
+        result = await self.grp.update_one({'id': int(chat)}, {'$setOnInsert': group}, upsert=True)
+        return result.upserted_id is not None
     
 
     async def get_chat(self, chat):
@@ -0,0 +1,477 @@
+"""
+Channel indexing engine. Three stages connected by bounded queues:
+
+    fetch  - get_messages over windows of message ids, newest first, several windows in flight
+             and paced by AIMD throttles (fetch_windows, also used by catch-up and /batch links)
+    parse  - pick the video/audio/document out of every message
+    write  - save the files in batches with save_files
+
+Each stage blocks once the queue after it is full, so Telegram fetches and MongoDB writes
+overlap and a run goes as fast as the slower of the two.
+
+Fetching is paced by one Throttle per chat and one per DC: while requests succeed the window
+grows and the pause between requests shrinks a step at a time, a FloodWait halves the window
+and doubles the pause. Throttles outlive the run, so the next index of a chat starts at the
+rate learned by the last one.
+"""
+import re
+import time
+import asyncio
+import logging
+from contextlib import aclosing
+from pyrogram import enums
+from pyrogram.errors import FloodWait, BotMethodInvalid
+from info import INDEX_FETCH_RATE
+from database.ia_filterdb import save_files
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+WRITE_BATCH = 200   # files per save_files call
+QUEUE_DEPTH = 4     # batches buffered between two stages
+IN_FLIGHT = 3       # get_messages calls a range fetch keeps running at once
+SEARCH_LIMIT = 100  # messages per search request, the most Telegram returns
+
+#server side filters of a media-only scan, a message matching two of them is indexed once
+SEARCH_FILTERS = (enums.MessagesFilter.VIDEO, enums.MessagesFilter.DOCUMENT, enums.MessagesFilter.AUDIO)
+
+ALLOWED_MEDIA = {
+    enums.MessageMediaType.VIDEO,
+    enums.MessageMediaType.AUDIO,
+    enums.MessageMediaType.DOCUMENT,
+}
+
+
+class IndexStats:
+    """Counters of one indexing run. `position` is the lowest message id whose batch is written."""
+
+    COUNTERS = ('fetched', 'saved', 'duplicate', 'errors', 'deleted', 'no_media', 'unsupported')
+
+    def __init__(self):
+        self.fetched = 0
+        self.saved = 0
+        self.duplicate = 0
+        self.errors = 0
+        self.deleted = 0
+        self.no_media = 0
+        self.unsupported = 0
+        self.position = None
+        self.rate = None    # messages fetched per second lately
+        self.chunk = None   # message ids per request now
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+    @classmethod
+    def from_dict(cls, counters):
+        stats = cls()
+        for name in cls.COUNTERS:
+            setattr(stats, name, counters.get(name, 0))
+        return stats
+
+    def text(self):
+        return (f"Total messages fetched: <code>{self.fetched}</code>\n"
+                f"Total files saved: <code>{self.saved}</code>\n"
+                f"Duplicate Files Skipped: <code>{self.duplicate}</code>\n"
+                f"Deleted Messages Skipped: <code>{self.deleted}</code>\n"
+                f"Non-Media messages skipped: <code>{self.no_media + self.unsupported}</code> (Unsupported Media - `{self.unsupported}`)\n"
+                f"Errors Occurred: <code>{self.errors}</code>"
+                + (f"\nFetch rate: <code>{self.rate:.0f}</code> msgs/s ({self.chunk} per request)" if self.rate else ""))
+
+
+class RateBudget:
+    """
+    Requests per second shared by every running index, spread evenly (0 = unlimited).
+    A FloodWait seen by one job pauses all of them, they use the same account.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self._next - now
+        self._next = max(now, self._next) + (1 / self.rate if self.rate else 0)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, secs):
+        self._next = max(self._next, time.monotonic() + secs)
+
+
+class Throttle:
+    """AIMD pacing of get_messages calls: `chunk` ids per call, at least `delay` seconds apart."""
+
+    MIN_CHUNK, MAX_CHUNK, CHUNK_STEP = 20, 200, 10   # get_messages takes at most 200 ids
+    MIN_DELAY, MAX_DELAY, DELAY_STEP = 0.0, 30.0, 0.05
+
+    def __init__(self, chunk=100, delay=0.5):
+        self.chunk = chunk
+        self.delay = delay
+        self._next = 0.0
+
+    async def acquire(self):
+        # the slot is taken before sleeping, so callers arriving together queue up `delay` apart
+        now = time.monotonic()
+        wait = self._next - now
+        self._next = max(now, self._next) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def success(self):
+        self.chunk = min(self.MAX_CHUNK, self.chunk + self.CHUNK_STEP)
+        self.delay = max(self.MIN_DELAY, self.delay - self.DELAY_STEP)
+
+    def flood(self, secs):
+        self.chunk = max(self.MIN_CHUNK, self.chunk // 2)
+        self.delay = min(self.MAX_DELAY, max(self.delay * 2, 0.5))
+        self._next = max(self._next, time.monotonic() + secs)
+
+
+#throttles by ('chat', account, id) and ('dc', account, number), kept for the life of the process.
+#account is None for the bot and 'user' for the indexing user session, they are limited separately
+THROTTLES = {}
+#every index job, catch-up and batch delivery draws from this one, INDEX_FETCH_RATE calls per second
+budget = RateBudget(INDEX_FETCH_RATE)
+
+
+def throttles_for(chat, dc_id=None, account=None):
+    keys = [('chat', account, chat)] + ([('dc', account, dc_id)] if dc_id else [])
+    return [THROTTLES.setdefault(key, Throttle()) for key in keys]
+
+
+async def resolve_chat(bot, chat):
+    """The Chat of an id or username, None when it can't be fetched. Its dc_id is None for chats without a photo."""
+    try:
+        return await bot.get_chat(chat)
+    except Exception:
+        return None
+
+
+def flood_wait_seconds(e):
+    """Seconds a FloodWait asks for, whichever attribute this pyrogram version keeps them in."""
+    for attr in ("value", "x", "seconds"):
+        secs = getattr(e, attr, None)
+        if isinstance(secs, int) and secs > 0:
+            return secs
+    found = re.search(r"\d+", str(e))
+    return int(found.group()) if found else 10
+
+
+def extract_media(message, stats):
+    """The video/audio/document of `message` with file_type and caption set, or None (counted in `stats`)."""
+    if not message or getattr(message, "empty", False):
+        stats.deleted += 1
+        return None
+    if not getattr(message, "media", None):
+        stats.no_media += 1
+        return None
+    if message.media not in ALLOWED_MEDIA:
+        stats.unsupported += 1
+        return None
+    media = getattr(message, message.media.value, None)
+    if not media:
+        stats.unsupported += 1
+        return None
+    media.file_type = message.media.value
+    media.caption = getattr(message, "caption", None)
+    media.chat_id = getattr(getattr(message, "chat", None), "id", None)
+    media.message_id = message.id
+    return media
+
+
+async def _paced(chat, call, throttles, budget=None):
+    """Await `call()` paced by `throttles` and `budget`, None after a FloodWait (which slows them down)."""
+    for throttle in throttles:
+        await throttle.acquire()
+    if budget:
+        await budget.acquire()
+    try:
+        result = await call()
+    except FloodWait as e:
+        secs = flood_wait_seconds(e)
+        logger.warning(f"FloodWait while fetching {chat}. Sleeping for {secs} seconds and slowing down...")
+        for throttle in throttles:
+            throttle.flood(secs)
+        if budget:
+            budget.pause(secs)
+        return None
+    for throttle in throttles:
+        throttle.success()
+    return result
+
+
+async def _get_messages(bot, chat, ids, throttles, budget=None):
+    return await _paced(chat, lambda: bot.get_messages(chat, ids), throttles, budget)
+
+
+async def fetch_windows(bot, chat, first_id, last_id=None, descending=False, budget=None, throttles=None, in_flight=IN_FLIGHT):
+    """
+    Messages `first_id`..`last_id` of `chat` as (low id, high id, messages) windows, in order
+    (highest first when `descending`). Up to `in_flight` windows are fetched at once, each
+    paced by `throttles` and `budget` and retried after a FloodWait. Without `last_id` it goes
+    on upwards until the caller stops, which needs `descending` False.
+    """
+    throttles = throttles or throttles_for(chat)
+    pending = []
+    edge = last_id if descending else first_id
+
+    async def window(low, high):
+        ids = list(range(high, low - 1, -1)) if descending else list(range(low, high + 1))
+        while (messages := await _get_messages(bot, chat, ids, throttles, budget)) is None:
+            pass
+        return low, high, messages
+
+    def schedule():
+        nonlocal edge
+        size = min(t.chunk for t in throttles)
+        while len(pending) < in_flight:
+            if descending:
+                if edge < first_id:
+                    return
+                low, high = max(first_id, edge - size + 1), edge
+                edge = low - 1
+            else:
+                if last_id is not None and edge > last_id:
+                    return
+                low, high = edge, edge + size - 1 if last_id is None else min(last_id, edge + size - 1)
+                edge = high + 1
+            pending.append(asyncio.create_task(window(low, high)))
+
+    try:
+        schedule()
+        while pending:
+            result = await pending.pop(0)
+            schedule()
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def iter_range(bot, chat, first_id, last_id, descending=False, budget=None):
+    """Every message `first_id`..`last_id` of `chat` one by one, in order. Deleted ones come as empty messages."""
+    async with aclosing(fetch_windows(bot, chat, first_id, last_id, descending, budget)) as windows:
+        async for _, _, messages in windows:
+            for message in messages:
+                yield message
+
+
+async def _page(chat, request, throttles, budget=None):
+    """The messages of one page of a history or search generator, `request()` starts it. Paced and retried after a FloodWait."""
+    async def collect():
+        return [message async for message in request()]
+    while (messages := await _paced(chat, collect, throttles, budget)) is None:
+        pass
+    return messages
+
+
+async def search_media(client, chat, first_id, last_id, budget=None, throttles=None):
+    """
+    Only the video, document and audio messages `last_id` down to `first_id` of `chat`, as
+    (low id, high id, messages) windows like fetch_windows, asking Telegram to filter them.
+    The three filtered searches are merged newest first. Searches page from the newest message,
+    pages above `last_id` are skipped. Raises BotMethodInvalid for bot sessions, which can't search.
+    """
+    throttles = throttles or throttles_for(chat)
+
+    async def chunk(filter, offset):
+        return await _page(chat, lambda: client.search_messages(chat, filter=filter, offset=offset, limit=SEARCH_LIMIT), throttles, budget)
+
+    # per filter: messages fetched but not merged yet, and the offset to search from next (None once done)
+    buffers = {filter: [] for filter in SEARCH_FILTERS}
+    offsets = {filter: 0 for filter in SEARCH_FILTERS}
+    window, high, previous = [], last_id, None
+    while True:
+        for filter in SEARCH_FILTERS:
+            while not buffers[filter] and offsets[filter] is not None:
+                found = await chunk(filter, offsets[filter])
+                buffers[filter] = [m for m in found if first_id <= m.id <= last_id]
+                done = len(found) < SEARCH_LIMIT or found[-1].id < first_id
+                offsets[filter] = None if done else offsets[filter] + len(found)
+        heads = [filter for filter in SEARCH_FILTERS if buffers[filter]]
+        if not heads:
+            break
+        message = buffers[max(heads, key=lambda f: buffers[f][0].id)].pop(0)
+        if message.id == previous:
+            continue
+        previous = message.id
+        window.append(message)
+        if len(window) >= SEARCH_LIMIT:
+            yield message.id, high, window
+            window, high = [], message.id - 1
+    if high >= first_id:
+        yield first_id, high, window
+
+
+async def history_windows(client, chat, first_id, last_id, budget=None, throttles=None):
+    """
+    Messages `last_id` down to `first_id` of `chat` through the chat history, newest first, as
+    (low id, high id, messages) windows like fetch_windows. Deleted ids are simply not there,
+    so no request is spent on them. Raises BotMethodInvalid for bot sessions.
+    """
+    throttles = throttles or throttles_for(chat)
+    below, high = last_id + 1, last_id
+    while True:
+        messages = await _page(
+            chat, lambda: client.get_chat_history(chat, limit=SEARCH_LIMIT, offset_id=below, min_id=first_id - 1), throttles, budget
+        )
+        messages = [m for m in messages if first_id <= m.id <= last_id]
+        if len(messages) < SEARCH_LIMIT:
+            break
+        below = messages[-1].id
+        yield below, high, messages
+        high = below - 1
+    if high >= first_id:
+        yield first_id, high, messages
+
+
+async def _save(batch, stats):
+    try:
+        results = await save_files(batch)
+    except Exception as e:
+        logger.exception("Error saving batch of %s files: %s", len(batch), e)
+        stats.errors += len(batch)
+        return
+    for saved, status in results:
+        if saved:
+            stats.saved += 1
+        elif status == 0:
+            stats.duplicate += 1
+        else:
+            stats.errors += 1
+
+
+async def _index_windows(bot, chat, last_id, first_id, budget, throttles, media_only):
+    """
+    Windows for run_index: user sessions search for media only (when asked) or read the history,
+    bots fetch every id of the range. A session refused with BotMethodInvalid falls back to the
+    range from where it got to.
+    """
+    top = last_id
+    me = getattr(bot, "me", None)
+    if me is not None and not me.is_bot:
+        source = search_media if media_only else history_windows
+        try:
+            async with aclosing(source(bot, chat, first_id, last_id, budget, throttles)) as windows:
+                async for window in windows:
+                    yield window
+                    top = window[0] - 1
+            return
+        except BotMethodInvalid:
+            logger.info(f"This session can't read the history of {chat}, fetching every message instead")
+    if top >= first_id:
+        async with aclosing(fetch_windows(bot, chat, first_id, top, True, budget, throttles)) as windows:
+            async for window in windows:
+                yield window
+
+
+async def run_index(bot, chat, last_id, first_id=1, stats=None, cancelled=None, progress=None, budget=None, throttles=None,
+                    media_only=False):
+    """
+    Index messages `last_id` down to `first_id` of `chat`. `cancelled` is an optional callable,
+    once it returns True no more messages are fetched and what was fetched is still saved.
+    `progress` is an optional coroutine called with the stats after every fetched window.
+    `budget` is an optional RateBudget every get_messages call waits for, `throttles` the
+    Throttles pacing this chat (its own one when not given, see throttles_for).
+    User sessions read the history (history_windows), or with `media_only` only get the
+    video/document/audio messages (search_media). Bots fetch every message id.
+    Returns the stats.
+    """
+    stats = stats or IndexStats()
+    throttles = throttles or throttles_for(chat)
+    fetched = asyncio.Queue(QUEUE_DEPTH)
+    parsed = asyncio.Queue(QUEUE_DEPTH)
+
+    async def fetch():
+        last_call = None
+        async with aclosing(_index_windows(bot, chat, last_id, first_id, budget, throttles, media_only)) as windows:
+            async for low, high, messages in windows:
+                now = time.monotonic()
+                if last_call:
+                    rate = (high - low + 1) / max(now - last_call, 1e-3)
+                    stats.rate = rate if stats.rate is None else 0.7 * stats.rate + 0.3 * rate
+                last_call = now
+                stats.chunk = min(t.chunk for t in throttles)
+                await fetched.put((low, messages))
+                if cancelled and cancelled():
+                    break
+        await fetched.put(None)
+
+    async def parse():
+        while (item := await fetched.get()) is not None:
+            low, messages = item
+            medias = []
+            for message in messages:
+                stats.fetched += 1
+                media = extract_media(message, stats)
+                if media:
+                    medias.append(media)
+            # windows without files go through too, so the writer's position keeps moving
+            await parsed.put((low, medias))
+            if progress:
+                await progress(stats)
+        await parsed.put(None)
+
+    async def write():
+        while (item := await parsed.get()) is not None:
+            low, batch = item
+            # take whatever else is parsed already, up to WRITE_BATCH files per write
+            while len(batch) < WRITE_BATCH and not parsed.empty():
+                more = parsed.get_nowait()
+                if more is None:
+                    await parsed.put(None)
+                    break
+                low = more[0]
+                batch = batch + more[1]
+            if batch:
+                await _save(batch, stats)
+            stats.position = low
+
+    tasks = [asyncio.create_task(stage()) for stage in (fetch, parse, write)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return stats
+
+
+async def catch_up(bot, chat, after, last_id, stats=None, budget=None, throttles=None):
+    """
+    Index messages `after`+1..`last_id` of `chat`, i.e. what it got while the bot was offline.
+    `last_id` is the newest message id of the chat, which bots can't ask for (see
+    plugins.channel.latest_message_id), so runs of deleted ids in between don't end it early.
+    """
+    stats = stats or IndexStats()
+    if last_id <= after:
+        return stats
+    throttles = throttles or throttles_for(chat)
+    async with aclosing(fetch_windows(bot, chat, after + 1, last_id, budget=budget, throttles=throttles, in_flight=2)) as windows:
+        async for _, _, messages in windows:
+            medias = []
+            for message in messages:
+                stats.fetched += 1
+                media = extract_media(message, stats)
+                if media:
+                    medias.append(media)
+            if medias:
+                await _save(medias, stats)
+    return stats
+
+
+def throttled_progress(edit, every=5):
+    """Progress coroutine for run_index that calls `edit(stats)` at most once every `every` seconds."""
+    last_edit = 0
+
+    async def progress(stats):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < every:
+            return
+        last_edit = time.monotonic()
+        try:
+            await edit(stats)
+        except Exception:
+            pass
+    return progress
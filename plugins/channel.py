@@ -1,20 +1,223 @@
+import asyncio
+import logging
 from pyrogram import Client, filters
-from info import CHANNELS
-from database.ia_filterdb import save_file
+from info import CHANNELS, CATCHUP_INTERVAL
+from database.ia_filterdb import save_files, find_posts, delete_posts, update_captions
+from database.index_state_db import get_high_water, set_high_water
+from database.ingest_queue import IngestQueue
+from indexer import catch_up, resolve_chat, throttles_for, budget
+import userbot
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 media_filter = filters.document | filters.video | filters.audio
+#CHANNELS, with the ids of the ones given by username added by resolve_channels(): deleted message
+#updates carry only the chat id, so a username alone never matches them
+channel_chats = filters.chat(CHANNELS)
+#chats whose catch-up finished since the bot started, only their live posts may raise the high-water mark.
+#before that the gap below the mark isn't indexed yet and raising it would skip the gap for good
+CAUGHT_UP = set()
+#live saves that failed by chat, a catch-up only counts the chat as caught up when none failed while it ran
+FAILURES = {}
+#newest message id seen in the updates of each channel since start, catch-up goes up to it
+LATEST = {}
+#chats whose catch-up waits for their newest message id, LATEST_SEEN is set when one of them posts
+WAITING = set()
+LATEST_SEEN = asyncio.Event()
 
 
-@Client.on_message(filters.chat(CHANNELS) & media_filter)
-async def media(bot, message):
-    """Media Handler"""
+def post_media(message):
+    """The document/video/audio of a channel post, tagged with where it came from, or None."""
     for file_type in ("document", "video", "audio"):
         media = getattr(message, file_type, None)
         if media is not None:
             break
     else:
-        return
+        return None
 
     media.file_type = file_type
     media.caption = message.caption
-    await save_file(media)
\ No newline at end of file
+    media.chat_id = message.chat.id
+    media.message_id = message.id
+    return media
+
+
+@Client.on_message(channel_chats, group=-1)
+async def track_latest(bot, message):
+    """Remember the newest message id of every channel, for catch-up."""
+    LATEST[message.chat.id] = max(message.id, LATEST.get(message.chat.id, 0))
+    if message.chat.id in WAITING:
+        LATEST_SEEN.set()
+
+
+@Client.on_message(channel_chats & media_filter)
+async def media(bot, message):
+    """Media Handler"""
+    media = post_media(message)
+    if media is not None:
+        await new_files.put((message.chat.id, message.id, media))
+
+
+@Client.on_deleted_messages(channel_chats)
+async def deleted(bot, messages):
+    """Drop the files of deleted posts from the index"""
+    for message in messages:
+        await deleted_posts.put((message.chat.id, message.id))
+
+
+@Client.on_edited_message(channel_chats)
+async def edited(bot, message):
+    """Follow caption changes and replaced or removed files of edited posts"""
+    await edited_posts.put((message.chat.id, message.id, post_media(message)))
+
+
+async def save_posts(posts):
+    """
+    Flush of new_files: save the batch, then raise the high-water mark of the caught up chats in it,
+    up to the post before their first failed one. Such a chat counts as not caught up any more,
+    so the mark stays below the failed post until the next catch-up has saved it.
+    """
+    results = await save_files([media for _, _, media in posts])
+    failed = {}
+    for (chat_id, message_id, _), (_, status) in zip(posts, results):
+        if status == 2:
+            failed[chat_id] = min(message_id, failed.get(chat_id, message_id))
+    if failed:
+        logger.warning(f"{sum(1 for _, status in results if status == 2)} of {len(posts)} channel files could not be saved")
+    newest = {}
+    caught_up = set(CAUGHT_UP)
+    CAUGHT_UP.difference_update(failed)
+    for chat_id in failed:
+        FAILURES[chat_id] = FAILURES.get(chat_id, 0) + 1
+    for chat_id, message_id, _ in posts:
+        if chat_id in caught_up and message_id < failed.get(chat_id, message_id + 1):
+            newest[chat_id] = max(message_id, newest.get(chat_id, 0))
+    for chat_id, message_id in newest.items():
+        await set_high_water(chat_id, message_id)
+
+
+async def sync_edits(posts):
+    """Flush of edited_posts: re-save posts whose file changed or was removed, update the caption of the rest."""
+    latest = {}
+    for chat_id, message_id, media in posts:
+        latest[(chat_id, message_id)] = media
+    found = await find_posts(list(latest))
+    replaced, captions, saves = [], [], []
+    for post, media in latest.items():
+        if post not in found:
+            # not indexed yet, or indexed before posts were tracked (then it's skipped as a duplicate)
+            if media is not None:
+                saves.append(media)
+            continue
+        shard, doc = found[post]
+        if media is None or doc.get('file_unique_id') != getattr(media, 'file_unique_id', None):
+            replaced.append(post)
+            if media is not None:
+                saves.append(media)
+        else:
+            captions.append((shard, doc['_id'], media.caption.html if media.caption else None))
+    if replaced:
+        await delete_posts(replaced)
+    if captions:
+        await update_captions(captions)
+    if saves:
+        await save_files(saves)
+    logger.info(f"Synced {len(latest)} edited posts: {len(replaced)} files replaced or removed, {len(captions)} captions updated")
+
+
+async def drop_posts(posts):
+    """Flush of deleted_posts."""
+    removed = await delete_posts(list(set(posts)))
+    if removed:
+        logger.info(f"Removed {removed} files of {len(posts)} deleted posts")
+
+
+def _unsaved(posts):
+    """Posts new_files gave up on, their chats wait for catch-up to save them before the mark moves again."""
+    for chat_id in {chat_id for chat_id, _, _ in posts}:
+        CAUGHT_UP.discard(chat_id)
+        FAILURES[chat_id] = FAILURES.get(chat_id, 0) + 1
+
+
+new_files = IngestQueue("Channel files", save_posts, on_drop=_unsaved)
+edited_posts = IngestQueue("Edited posts", sync_edits)
+deleted_posts = IngestQueue("Deleted posts", drop_posts)
+
+
+async def resolve_channels(bot):
+    """Add the id of every channel of CHANNELS given by username to channel_chats, on start."""
+    for channel in CHANNELS:
+        if isinstance(channel, str):
+            chat = await resolve_chat(bot, channel)
+            if chat:
+                channel_chats.add(chat.id)
+            else:
+                logger.warning(f"Can't resolve channel {channel}, its deleted posts stay in the index")
+
+
+async def latest_message_id(chat):
+    """
+    Newest message id of `chat`, asked through the indexing user session when there is one.
+    Bots can't ask, for them it is the newest id seen in updates since start, None before the chat posted.
+    """
+    if userbot.client is not None:
+        try:
+            async for message in userbot.client.get_chat_history(chat, limit=1):
+                return max(message.id, LATEST.get(chat, 0))
+        except Exception as e:
+            logger.info(f"User session can't read the history of {chat} ({e})")
+    return LATEST.get(chat)
+
+
+async def catch_up_channels(bot):
+    """Index what every channel of CHANNELS got after its high-water mark, i.e. while the bot was offline."""
+    for channel in filter(None, CHANNELS):
+        chat = await resolve_chat(bot, channel)
+        if not chat:
+            logger.warning(f"Catch-up: can't access channel {channel}")
+            continue
+        channel_chats.add(chat.id)
+        after = await get_high_water(chat.id)
+        if after is None:
+            # nothing known about it yet, a full /index sets the mark (so do new posts from now on)
+            logger.info(f"Catch-up: no high-water mark for {channel}, index it once to enable catch-up")
+            CAUGHT_UP.add(chat.id)
+            continue
+        last_id = await latest_message_id(chat.id)
+        if last_id is None:
+            WAITING.add(chat.id)
+            logger.info(f"Catch-up of {channel}: newest message id not known yet, waiting for its next post")
+            continue
+        WAITING.discard(chat.id)
+        failures = FAILURES.get(chat.id, 0)
+        try:
+            stats = await catch_up(bot, chat.id, after, last_id, budget=budget, throttles=throttles_for(chat.id, chat.dc_id))
+        except Exception as e:
+            logger.exception(f"Catch-up of {channel} failed: {e}")
+            continue
+        if stats.errors:
+            # keep the mark, the next catch-up goes over the gap again and skips what got saved
+            logger.warning(f"Catch-up of {channel}: {stats.errors} files could not be saved, retrying on the next run")
+            continue
+        if last_id > after:
+            await set_high_water(chat.id, last_id)
+            logger.info(f"Catch-up of {channel}: messages {after + 1}-{last_id}, saved {stats.saved}, duplicates {stats.duplicate}")
+        if FAILURES.get(chat.id, 0) == failures:
+            CAUGHT_UP.add(chat.id)
+
+
+async def catch_up_loop(bot):
+    """Catch up on start, then every CATCHUP_INTERVAL seconds and as soon as a channel that was waiting posts."""
+    while True:
+        LATEST_SEEN.clear()
+        try:
+            await catch_up_channels(bot)
+        except Exception as e:
+            logger.exception(f"Catch-up failed: {e}")
+        if not CATCHUP_INTERVAL and not WAITING:
+            return
+        try:
+            await asyncio.wait_for(LATEST_SEEN.wait(), CATCHUP_INTERVAL or None)
+        except asyncio.TimeoutError:
+            pass
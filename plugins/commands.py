@@ -3,7 +3,7 @@ from Script import script
 from pyrogram import Client, filters, enums
 from pyrogram.errors import UserNotParticipant, ChatAdminRequired, PeerIdInvalid, FloodWait
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from database.ia_filterdb import Media, Media2, get_file_details, unpack_new_file_id
+from database.ia_filterdb import Media, Media2, get_file_details, unpack_new_file_id, forget_file
 from database.users_chats_db import db
 from info import CHANNELS, REACTIONS, ADMINS, AUTH_CHANNEL, LOG_CHANNEL, PICS, BATCH_FILE_CAPTION, CUSTOM_FILE_CAPTION, PROTECT_CONTENT
 from utils import get_settings, get_size, is_subscribed, save_group_settings, temp
@@ -37,17 +37,15 @@ async def start(client, message: Message):
         )
         await asyncio.sleep(2)
 
-        if not await db.get_chat(message.chat.id):
+        if await db.add_chat(message.chat.id, message.chat.title):
             total = await client.get_chat_members_count(message.chat.id)
             await client.send_message(
                 LOG_CHANNEL,
                 script.LOG_TEXT_G.format(message.chat.title, message.chat.id, total, "Unknown")
             )
-            await db.add_chat(message.chat.id, message.chat.title)
         return
 
-    if not await db.is_user_exist(message.from_user.id):
-        await db.add_user(message.from_user.id, message.from_user.first_name)
+    if await db.add_user(message.from_user.id, message.from_user.first_name):
         await client.send_message(
             LOG_CHANNEL,
             script.LOG_TEXT_P.format(message.from_user.id, message.from_user.mention)
@@ -262,6 +260,9 @@ async def start(client, message: Message):
             return
         except:
             pass
+        if files_.partial:
+            # the db holding it may be the one that is skipped right now
+            return await message.reply('Database is busy, please try again in a minute.')
         return await message.reply('No such file exist.')
     files = files_[0]
     title = files.file_name
@@ -355,8 +356,11 @@ async def delete(bot, message):
             '_id': file_id,
         })
     if result.deleted_count:
+        forget_file(file_id)
         await msg.edit('Fɪʟᴇ ɪs sᴜᴄᴄᴇssғᴜʟʟʏ ᴅᴇʟᴇᴛᴇᴅ ғʀᴏᴍ ᴅᴀᴛᴀʙᴀsᴇ')
     else:
+        # the deleted copies' file_ids are unknown here, so drop every cached file
+        forget_file()
         file_name = re.sub(r"(_|\-|\.|\+)", " ", str(media.file_name))
         result = await Media.collection.delete_many({
             'file_name': file_name,
@@ -420,6 +424,7 @@ async def delete_all_index(bot, message):
 async def delete_all_index_confirm(bot, message):
     await Media.collection.drop()
     await Media2.collection.drop()
+    forget_file()
     await message.answer('Piracy Is Crime')
     await message.message.edit('Succesfully Deleted All The Indexed Files.')
 
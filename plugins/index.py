@@ -1,9 +1,9 @@
 import logging
+import time
 import asyncio
 import re
 from datetime import datetime
 from pyrogram import Client, filters, enums
-from pyrogram.errors import FloodWait
 from pyrogram.errors.exceptions.bad_request_400 import (
     ChannelInvalid,
     ChatAdminRequired,
@@ -12,16 +12,16 @@ from pyrogram.errors.exceptions.bad_request_400 import (
 )
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from info import ADMINS
+from info import ADMINS, INDEX_CHECKPOINT_SECS, INDEX_WORKERS, INDEX_MEDIA_ONLY
 from info import INDEX_REQ_CHANNEL as LOG_CHANNEL
-from database.ia_filterdb import save_file
+from indexer import IndexStats, budget, run_index, throttled_progress, throttles_for
+from userbot import index_client
+from database.index_state_db import create_job, set_status, save_checkpoint, finish_job, interrupted_jobs, set_high_water, QUEUED, RUNNING, DONE, CANCELLED, FAILED
 from utils import temp
 
 # -------------------------
-# Configurable runtime options
+# Configurable runtime options (batch sizes and queue depths are in indexer.py)
 # -------------------------
-CHUNK_SIZE = 100        # messages per batch (reduce to avoid FloodWait)
-BATCH_SLEEP = 0.5       # seconds to sleep after each batch (0 = no sleep)
 ENABLE_FILE_LOG = False # write progress to /tmp/index_progress.log if True
 # -------------------------
 
@@ -35,7 +35,10 @@ if ENABLE_FILE_LOG:
     fh.setFormatter(fmt)
     logger.addHandler(fh)
 
-lock = asyncio.Lock()
+#queued and running index jobs by id, INDEX_WORKERS of them run at once and share indexer.budget
+JOBS = {}
+queue = asyncio.Queue()
+workers = []
 
 # regex to detect t.me / telegram.me / telegram.dog links (including /c/ style)
 TME_RE = re.compile(
@@ -91,7 +94,10 @@ async def index_files(bot: Client, query):
     """
     data = query.data or ""
     if data.startswith("index_cancel"):
-        temp.CANCEL = True
+        run = JOBS.get(data.partition("#")[2])
+        if not run:
+            return await query.answer("This index is not running anymore.", show_alert=True)
+        await cancel_run(run)
         return await query.answer("Cancelling Indexing", show_alert=False)
 
     parts = data.split("#")
@@ -115,8 +121,8 @@ async def index_files(bot: Client, query):
             pass
         return await query.answer("Rejected", show_alert=False)
 
-    if lock.locked():
-        return await query.answer("Wait until previous process completes.", show_alert=True)
+    if any(str(run.job['chat']) == chat for run in JOBS.values()):
+        return await query.answer("This chat is already queued for indexing.", show_alert=True)
 
     await query.answer("Processing...⏳", show_alert=False)
 
@@ -131,17 +137,6 @@ async def index_files(bot: Client, query):
     except Exception:
         pass
 
-    # Edit moderator message to show starting progress and cancel button
-    try:
-        await query.message.edit(
-            "Starting Indexing",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("Cancel", callback_data="index_cancel")]]
-            ),
-        )
-    except Exception:
-        pass
-
     # coerce chat if possible
     try:
         target_chat = int(chat)
@@ -153,7 +148,17 @@ async def index_files(bot: Client, query):
     except Exception:
         lst_msg_id_int = None
 
-    await index_files_to_db(lst_msg_id_int, target_chat, query.message, bot)
+    run = await enqueue_index(lst_msg_id_int, target_chat, query.message, bot)
+    if not run:
+        return
+    # Edit moderator message to show the job and its cancel button
+    try:
+        await query.message.edit(
+            f"Queued as job <code>{run.id}</code>, {queue.qsize() - 1} jobs ahead of it.",
+            reply_markup=cancel_markup(run),
+        )
+    except Exception:
+        pass
 
 
 @Client.on_message(
@@ -264,21 +269,55 @@ async def set_skip_number(bot: Client, message):
     return await message.reply("Give me a skip number")
 
 
-async def index_files_to_db(lst_msg_id, chat, msg, bot: Client):
-    """
-    Core indexing logic (walks messages from lst_msg_id downward).
-    Uses FW1 behavior on FloodWait (sleep and retry).
-    """
-    total_files = 0
-    duplicate = 0
-    errors = 0
-    deleted = 0
-    no_media = 0
-    unsupported = 0
+@Client.on_message(filters.command("indexjobs") & filters.user(ADMINS))
+async def list_index_jobs(bot: Client, message):
+    if not JOBS:
+        return await message.reply("No index jobs are queued or running.")
+    lines = []
+    for run in JOBS.values():
+        state = "running" if run.running else "queued"
+        lines.append(f"<code>{run.id}</code> - <code>{run.job['chat']}</code> {state}, fetched <code>{run.stats.fetched}</code>, saved <code>{run.stats.saved}</code>")
+    await message.reply(f"<b>Index jobs</b> ({INDEX_WORKERS} run at once)\n\n" + "\n".join(lines))
 
-    async with lock:
-        temp.CANCEL = False
-        current_pointer = temp.CURRENT if hasattr(temp, "CURRENT") and isinstance(temp.CURRENT, int) else 0
+
+class IndexRun:
+    """A queued or running index job: its document, progress message, counters and cancel flag."""
+
+    def __init__(self, job, msg):
+        self.job = job
+        self.msg = msg
+        self.stats = IndexStats.from_dict(job['stats'])
+        self.cancelled = False
+        self.running = False
+
+    @property
+    def id(self):
+        return self.job['_id']
+
+
+def cancel_markup(run):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"index_cancel#{run.id}")]])
+
+
+async def cancel_run(run):
+    """Stop a running job after its current window, or drop a queued one."""
+    run.cancelled = True
+    if run.running:
+        return
+    JOBS.pop(run.id, None)
+    await finish_job(run.id, CANCELLED, run.stats.position, run.stats.to_dict())
+    try:
+        await run.msg.edit(f"Cancelled job <code>{run.id}</code> before it started.")
+    except Exception:
+        pass
+
+
+async def _prepare(lst_msg_id, chat, msg, bot: Client, job, status):
+    """Create the job document (or reuse an interrupted one) and register it, None if there is nothing to index."""
+    if job:
+        await set_status(job['_id'], status)
+    else:
+        first_id = max(temp.CURRENT if isinstance(getattr(temp, "CURRENT", None), int) else 1, 1)
 
         # determine starting message id if not provided
         if not lst_msg_id:
@@ -290,185 +329,108 @@ async def index_files_to_db(lst_msg_id, chat, msg, bot: Client):
                 lst_msg_id = None
 
         if not lst_msg_id:
-            return await msg.edit("Could not determine the starting message id for indexing.")
+            await msg.edit("Could not determine the starting message id for indexing.")
+            return None
+        job = await create_job(chat, lst_msg_id, first_id, msg.chat.id, msg.id, status=status)
+    run = IndexRun(job, msg)
+    JOBS[run.id] = run
+    return run
+
+
+async def enqueue_index(lst_msg_id, chat, msg, bot: Client, job=None):
+    """Queue an index (or an interrupted `job`) for the workers, returns its IndexRun or None."""
+    run = await _prepare(lst_msg_id, chat, msg, bot, job, QUEUED)
+    if run:
+        queue.put_nowait(run)
+        while len(workers) < INDEX_WORKERS:
+            workers.append(asyncio.create_task(_worker(bot)))
+    return run
+
+
+async def _worker(bot: Client):
+    while True:
+        run = await queue.get()
+        try:
+            if not run.cancelled:
+                await _run(run, bot)
+        except Exception as e:
+            logger.exception("Index worker error: %s", e)
+        finally:
+            queue.task_done()
 
-        offset_id = lst_msg_id
-        chunk_size = int(CHUNK_SIZE) if CHUNK_SIZE and isinstance(CHUNK_SIZE, int) else 100
 
+async def index_files_to_db(lst_msg_id, chat, msg, bot: Client, job=None):
+    """
+    Index right away, outside the queue (walks messages from lst_msg_id down to the SKIP number).
+    Fetching, parsing and saving run as a pipeline, see indexer.run_index.
+    The run is checkpointed every INDEX_CHECKPOINT_SECS, `job` is an interrupted run to resume.
+    """
+    run = await _prepare(lst_msg_id, chat, msg, bot, job, RUNNING)
+    if run:
+        await _run(run, bot)
+
+
+async def _run(run, bot: Client):
+    job, msg, stats = run.job, run.msg, run.stats
+    run.running = True
+    await set_status(run.id, RUNNING)
+    chat, first_id = job['chat'], job['first_id']
+    lst_msg_id = job['position'] - 1 if job['position'] else job['last_id']
+    last_checkpoint = time.monotonic()
+
+    async def edit(stats):
+        nonlocal last_checkpoint
+        if stats.position and time.monotonic() - last_checkpoint >= INDEX_CHECKPOINT_SECS:
+            last_checkpoint = time.monotonic()
+            await save_checkpoint(run.id, stats.position, stats.to_dict())
+        await msg.edit_text(text=f"Job <code>{run.id}</code> - <code>{chat}</code>\n\n{stats.text()}", reply_markup=cancel_markup(run))
+
+    try:
+        # the user session when there is one that can see the chat, it shares the fetch budget with the bot
+        client, info = await index_client(bot, chat)
+        throttles = throttles_for(chat, getattr(info, "dc_id", None), None if client is bot else 'user')
+        await run_index(client, chat, lst_msg_id, first_id, stats, cancelled=lambda: run.cancelled,
+                        progress=throttled_progress(edit), budget=budget, throttles=throttles,
+                        media_only=INDEX_MEDIA_ONLY)
+    except Exception as e:
+        logger.exception("Indexing error: %s", e)
+        await finish_job(run.id, FAILED, stats.position, stats.to_dict())
         try:
-            while offset_id and offset_id > 0 and not temp.CANCEL:
-                # iterate messages older than or equal to offset_id (descending)
-                try:
-                    async for message in bot.iter_messages(chat, offset_id=offset_id, limit=chunk_size, reverse=False):
-                        if temp.CANCEL:
-                            break
-
-                        current_pointer += 1
-
-                        # periodic progress update
-                        if current_pointer % 32 == 0:
-                            try:
-                                await msg.edit_text(
-                                    text=f"Total messages fetched: <code>{current_pointer}</code>\n"
-                                         f"Total files saved: <code>{total_files}</code>\n"
-                                         f"Duplicate Files Skipped: <code>{duplicate}</code>\n"
-                                         f"Deleted Messages Skipped: <code>{deleted}</code>\n"
-                                         f"Non-Media messages skipped: <code>{no_media + unsupported}</code> (Unsupported Media - `{unsupported}`)\n"
-                                         f"Errors Occurred: <code>{errors}</code>",
-                                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="index_cancel")]]),
-                                )
-                            except Exception:
-                                pass
-
-                        if not message:
-                            deleted += 1
-                            continue
-
-                        this_msg_id = getattr(message, "message_id", getattr(message, "id", None))
-                        if this_msg_id is None:
-                            deleted += 1
-                            continue
-
-                        # deleted message
-                        if getattr(message, "empty", False):
-                            deleted += 1
-                            offset_id = this_msg_id - 1
-                            continue
-
-                        # no media
-                        if not getattr(message, "media", None):
-                            no_media += 1
-                            offset_id = this_msg_id - 1
-                            continue
-
-                        # accept only AUDIO / VIDEO / DOCUMENT
-                        allowed = {
-                            enums.MessageMediaType.VIDEO,
-                            enums.MessageMediaType.AUDIO,
-                            enums.MessageMediaType.DOCUMENT,
-                        }
-                        if message.media not in allowed:
-                            unsupported += 1
-                            offset_id = this_msg_id - 1
-                            continue
-
-                        # get the actual media object
-                        media_attr = getattr(message.media, "value", None)
-                        media = getattr(message, media_attr, None) if media_attr else None
-                        if not media:
-                            media = getattr(message, "video", None) or getattr(message, "audio", None) or getattr(message, "document", None)
-                        if not media:
-                            unsupported += 1
-                            offset_id = this_msg_id - 1
-                            continue
-
-                        # attach expected metadata
-                        media.file_type = getattr(message.media, "value", None)
-                        media.caption = getattr(message, "caption", None)
-
-                        # attempt to save (handle FloodWait by sleeping and retrying once)
-                        try:
-                            aynav, vnay = await save_file(media)
-                        except FloodWait as e:
-                            # FW1: sleep and retry
-                            secs = None
-                            for attr in ("value", "x", "seconds", "wait", "retry_after"):
-                                secs = getattr(e, attr, None)
-                                if secs:
-                                    break
-                            try:
-                                secs = int(secs)
-                            except Exception:
-                                try:
-                                    secs = int("".join([c for c in str(e) if c.isdigit()]) or 10)
-                                except:
-                                    secs = 10
-                            logger.warning(f"FloodWait triggered. Sleeping for {secs} seconds...")
-                            await asyncio.sleep(secs)
-                            try:
-                                aynav, vnay = await save_file(media)
-                            except Exception as exc:
-                                logger.exception("Error saving after FloodWait: %s", exc)
-                                errors += 1
-                                offset_id = this_msg_id - 1
-                                continue
-                        except Exception as exc:
-                            logger.exception("Error saving file: %s", exc)
-                            errors += 1
-                            offset_id = this_msg_id - 1
-                            continue
-
-                        if aynav:
-                            total_files += 1
-                        else:
-                            if vnay == 0:
-                                duplicate += 1
-                            elif vnay == 2:
-                                errors += 1
-
-                        offset_id = this_msg_id - 1
-
-                    # end of batch iteration
-
-                    if temp.CANCEL:
-                        await msg.edit(
-                            f"Successfully Cancelled!!\n\nSaved <code>{total_files}</code> files to database!\n"
-                            f"Duplicate Files Skipped: <code>{duplicate}</code>\n"
-                            f"Deleted Messages Skipped: <code>{deleted}</code>\n"
-                            f"Non-Media messages skipped: <code>{no_media + unsupported}</code> (Unsupported Media - `{unsupported}` )\n"
-                            f"Errors Occurred: <code>{errors}</code>"
-                        )
-                        break
-
-                    if not offset_id or offset_id <= 0:
-                        break
-
-                    # optional gentler sleep between batches
-                    if BATCH_SLEEP and isinstance(BATCH_SLEEP, (int, float)) and BATCH_SLEEP > 0:
-                        await asyncio.sleep(float(BATCH_SLEEP))
-
-                except FloodWait as e:
-                    # FW1 for batch-level FloodWait
-                    secs = None
-                    for attr in ("value", "x", "seconds", "wait", "retry_after"):
-                        secs = getattr(e, attr, None)
-                        if secs:
-                            break
-                    try:
-                        secs = int(secs)
-                    except Exception:
-                        try:
-                            secs = int("".join([c for c in str(e) if c.isdigit()]) or 10)
-                        except:
-                            secs = 10
-                    logger.warning(f"FloodWait during batch iteration. Sleeping for {secs} seconds...")
-                    await asyncio.sleep(secs)
-                    continue
-
-            # finished main while loop
-        except Exception as e:
-            logger.exception("Indexing error: %s", e)
-            try:
-                await msg.edit(f"Error during indexing: {e}")
-            except Exception:
-                pass
-        else:
-            try:
-                await msg.edit(
-                    f"Successfully saved <code>{total_files}</code> to database!\n"
-                    f"Duplicate Files Skipped: <code>{duplicate}</code>\n"
-                    f"Deleted Messages Skipped: <code>{deleted}</code>\n"
-                    f"Non-Media messages skipped: <code>{no_media + unsupported}</code> (Unsupported Media - `{unsupported}` )\n"
-                    f"Errors Occurred: <code>{errors}</code>"
-                )
-            except Exception:
-                pass
+            await msg.edit(f"Error during indexing: {e}\n\n{stats.text()}")
+        except Exception:
+            pass
+    else:
+        await finish_job(run.id, CANCELLED if run.cancelled else DONE, stats.position, stats.to_dict())
+        if not run.cancelled and not stats.errors and info:
+            # everything up to last_id is in now, catch-up indexing carries on from there
+            await set_high_water(info.id, job['last_id'])
+        try:
+            if run.cancelled:
+                await msg.edit(f"Successfully Cancelled!!\n\n{stats.text()}")
+            else:
+                await msg.edit(f"Successfully saved <code>{stats.saved}</code> to database!\n\n{stats.text()}")
+        except Exception:
+            pass
+    finally:
+        JOBS.pop(run.id, None)
+
+    # final optional file log
+    if ENABLE_FILE_LOG:
+        logger.info(
+            f"Index finished. Saved:{stats.saved} duplicates:{stats.duplicate} deleted:{stats.deleted} "
+            f"non_media:{stats.no_media} unsupported:{stats.unsupported} errors:{stats.errors}"
+        )
 
-        # final optional file log
-        if ENABLE_FILE_LOG:
-            try:
-                logger.info(
-                    f"Index finished. Saved:{total_files} duplicates:{duplicate} deleted:{deleted} non_media:{no_media} unsupported:{unsupported} errors:{errors}"
-                )
-            except Exception:
-                pass
+
+async def resume_index_jobs(bot: Client):
+    """Queue again the indexes a restart or crash interrupted, running ones continue from their last checkpoint."""
+    for job in await interrupted_jobs():
+        msg = None
+        try:
+            msg = await bot.get_messages(job['msg_chat_id'], job['msg_id'])
+        except Exception:
+            pass
+        if not msg or getattr(msg, "empty", False):
+            msg = await bot.send_message(job['msg_chat_id'] or LOG_CHANNEL, f"Resuming indexing of <code>{job['chat']}</code>")
+        logger.info(f"Resuming indexing of {job['chat']} from message {job['position'] or job['last_id']}")
+        await enqueue_index(None, job['chat'], msg, bot, job=job)
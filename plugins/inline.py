@@ -4,7 +4,7 @@ from pyrogram.errors.exceptions.bad_request_400 import QueryIdInvalid
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultCachedDocument, InlineQuery
 from database.ia_filterdb import get_search_results
 from utils import is_subscribed, get_size, temp
-from info import CACHE_TIME, AUTH_USERS, AUTH_CHANNEL, CUSTOM_FILE_CAPTION
+from info import CACHE_TIME, AUTH_USERS, AUTH_CHANNEL, CUSTOM_FILE_CAPTION, SEARCH_BUDGET_INLINE_MS
 from database.connections_mdb import active_connection
 
 logger = logging.getLogger(__name__)
@@ -56,7 +56,8 @@ async def answer(bot, query):
                                                   string,
                                                   file_type=file_type,
                                                   max_results=10,
-                                                  offset=offset)
+                                                  offset=offset,
+                                                  budget_ms=SEARCH_BUDGET_INLINE_MS)
 
     for file in files:
         title=file.file_name
@@ -78,14 +79,18 @@ async def answer(bot, query):
                 description=f'Size: {get_size(file.file_size)}\nType: {file.file_type}',
                 reply_markup=reply_markup))
 
+    # partial results (a db was not answering) are not cached by telegram
+    partial = getattr(files, 'partial', False)
     if results:
         switch_pm_text = f"{emoji.FILE_FOLDER} Results - {total}"
         if string:
             switch_pm_text += f" for {string}"
+        if partial:
+            switch_pm_text += " (more may exist)"
         try:
             await query.answer(results=results,
                            is_personal = True,
-                           cache_time=cache_time,
+                           cache_time=0 if partial else cache_time,
                            switch_pm_text=switch_pm_text,
                            switch_pm_parameter="start",
                            next_offset=str(next_offset))
@@ -97,10 +102,12 @@ async def answer(bot, query):
         switch_pm_text = f'{emoji.CROSS_MARK} No results'
         if string:
             switch_pm_text += f' for "{string}"'
+        if partial:
+            switch_pm_text += " yet, try again soon"
 
         await query.answer(results=[],
                            is_personal = True,
-                           cache_time=cache_time,
+                           cache_time=0 if partial else cache_time,
                            switch_pm_text=switch_pm_text,
                            switch_pm_parameter="okay")
 
@@ -0,0 +1,302 @@
+import os
+import time
+import logging
+from pyrogram import Client, filters
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from info import ADMINS
+from database.dedupe import collapse_duplicates
+from database.near_dupes import find_near_duplicates, purge_near_duplicates
+from database.catalog_io import export_catalog, import_catalog, SHARDS, TARGETS
+from database.backfill import BACKFILLS, get_checkpoint, start_backfill
+from database.placement import COLLECTIONS, CLUSTERS, placement_report, migrate
+from database.users_chats_db import db
+from database.filters_mdb import ensure_indexes as ensure_filter_indexes
+from database.ia_filterdb import file_cache, file_routes, shard_health
+from database.ingest_queue import QUEUES
+from database.file_cache import TTLCache
+from utils import get_size
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#latest /neardupes report of each admin, (report key, clusters) until it is purged or an hour old
+NEAR_DUPES = TTLCache(maxsize=50, ttl=3600)
+
+
+def _rate_line(name, stats):
+    return (f"<b>{name}:</b> <code>{stats['size']}</code> entries, hit rate <code>{stats['hit_rate'] * 100:.1f}%</code> "
+            f"({stats['hits']} hits / {stats['misses']} misses)")
+
+
+def _queue_line(queue):
+    stats = queue.stats()
+    return (f"<b>{queue.name}:</b> <code>{stats['depth']}</code> waiting, flush <code>{stats['latency_ms']}ms</code> "
+            f"({stats['flushed']} in {stats['batches']} batches, {stats['retried']} retries, {stats['dropped']} dropped)")
+
+
+def _health_line(health):
+    stats = health.stats()
+    return (f"<b>{health.name}:</b> <code>{stats['state']}</code>, latency <code>{stats['latency_ms']}ms</code>, "
+            f"errors <code>{stats['error_rate'] * 100:.1f}%</code> ({stats['errors']}/{stats['calls']} calls, {stats['trips']} trips)")
+
+
+@Client.on_message(filters.command('dbstatus') & filters.user(ADMINS))
+async def db_status(bot, message):
+    """Runtime metrics of the database layer"""
+    lines = [
+        "<b>📊 Database layer status</b>\n",
+        _rate_line("File cache", file_cache.stats()),
+        _rate_line("Shard routes", file_routes.stats()),
+        "",
+        *(_health_line(health) for health in shard_health),
+        "",
+        *(_queue_line(queue) for queue in QUEUES),
+    ]
+    await message.reply_text("\n".join(lines), quote=True)
+
+
+@Client.on_message(filters.command('dedupe') & filters.user(ADMINS))
+async def dedupe_index(bot, message):
+    """Collapse re-uploaded files stored in both databases"""
+    await message.reply_text(
+        'This will delete every re-upload of an indexed file across both databases, keeping the first copy.\nDo you want to continue??',
+        reply_markup=InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton(text="YES", callback_data="dedupe_confirm")],
+                [InlineKeyboardButton(text="CANCEL", callback_data="close_data")],
+            ]
+        ),
+        quote=True,
+    )
+
+
+@Client.on_callback_query(filters.regex(r'^dedupe_confirm') & filters.user(ADMINS))
+async def dedupe_index_confirm(bot, query):
+    await query.answer('Collapsing duplicates...')
+    msg = query.message
+    last_edit = 0
+
+    async def progress(scanned, removed):
+        nonlocal last_edit
+        if time.time() - last_edit < 10:
+            return
+        last_edit = time.time()
+        try:
+            await msg.edit(f"Scanned <code>{scanned}</code> files\nRemoved <code>{removed}</code> re-uploads")
+        except Exception:
+            pass
+
+    try:
+        scanned, removed, fingerprinted = await collapse_duplicates(progress=progress)
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while collapsing duplicates: {e}")
+    await msg.edit(
+        f"Duplicate cleanup finished!\n\nScanned: <code>{scanned}</code>\n"
+        f"Re-uploads removed: <code>{removed}</code>\n"
+        f"Files fingerprinted: <code>{fingerprinted}</code>"
+    )
+
+
+@Client.on_message(filters.command('neardupes') & filters.user(ADMINS))
+async def near_dupes_report(bot, message):
+    """Report near-duplicate titles, optionally only among the files matching a query: /neardupes [threshold] [query]"""
+    args = message.text.split(None, 1)[1].split() if len(message.command) > 1 else []
+    threshold = 0.7
+    if args:
+        try:
+            threshold = float(args[0])
+            args = args[1:]
+        except ValueError:
+            pass
+    if not 0 < threshold <= 1:
+        return await message.reply('Threshold should be between 0 and 1.')
+    query = " ".join(args)
+    msg = await message.reply("Pʀᴏᴄᴇssɪɴɢ...⏳", quote=True)
+    try:
+        clusters = await find_near_duplicates(threshold, query or None)
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while clustering: {e}")
+    if not clusters:
+        return await msg.edit('No near-duplicate files found.')
+
+    extra = sum(len(c) - 1 for c in clusters)
+    file = f'near_duplicates_{message.id}.txt'
+    with open(file, 'w') as f:
+        for i, cluster in enumerate(clusters, start=1):
+            f.write(f"#{i}\n")
+            for n, (shard, file_id, file_name, file_size) in enumerate(cluster):
+                f.write(f"{'KEEP' if n == 0 else 'DROP'} [DB{shard + 1}] [{get_size(file_size)}] {file_name}\n")
+            f.write("\n")
+    key = f"{message.chat.id}-{message.id}"
+    # a new report replaces the admin's previous one, whose PURGE button then expires
+    NEAR_DUPES.set(message.from_user.id, (key, clusters))
+    await message.reply_document(
+        file,
+        caption=f"Found <code>{len(clusters)}</code> clusters of near-duplicate files (threshold {threshold}).\n"
+                f"Purging keeps the largest file of each cluster and deletes the other <code>{extra}</code>.",
+        reply_markup=InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton(text="PURGE", callback_data=f"neardupes_purge#{key}")],
+                [InlineKeyboardButton(text="CANCEL", callback_data="close_data")],
+            ]
+        ),
+        quote=True,
+    )
+    os.remove(file)
+    await msg.delete()
+
+
+@Client.on_callback_query(filters.regex(r'^neardupes_purge') & filters.user(ADMINS))
+async def near_dupes_purge(bot, query):
+    key = query.data.split("#", 1)[1]
+    report = NEAR_DUPES.get(query.from_user.id)
+    if not report or report[0] != key:
+        return await query.answer("This report has expired, run /neardupes again.", show_alert=True)
+    NEAR_DUPES.pop(query.from_user.id)
+    clusters = report[1]
+    await query.answer('Purging near duplicates...')
+    try:
+        removed = await purge_near_duplicates(clusters)
+    except Exception as e:
+        logger.exception(e)
+        return await query.message.edit_caption(f"Error while purging: {e}")
+    await query.message.edit_caption(f"Purged <code>{removed}</code> near-duplicate files from <code>{len(clusters)}</code> clusters.")
+
+
+def _throttled(edit, every=10):
+    """Wrap a progress coroutine so it edits the status message at most once every `every` seconds."""
+    last_edit = 0
+
+    async def progress(*counts):
+        nonlocal last_edit
+        if time.time() - last_edit < every:
+            return
+        last_edit = time.time()
+        try:
+            await edit(*counts)
+        except Exception:
+            pass
+    return progress
+
+
+@Client.on_message(filters.command('export') & filters.user(ADMINS))
+async def export_files(bot, message):
+    """Export the files db to a compressed file: /export [all|media|media2] [bson|ndjson]"""
+    args = message.command[1:]
+    shards = args[0].lower() if args else 'all'
+    kind = args[1].lower() if len(args) > 1 else 'bson'
+    if shards not in SHARDS or kind not in ('bson', 'ndjson'):
+        return await message.reply('Usage: /export [all|media|media2] [bson|ndjson]')
+    msg = await message.reply("Exporting...⏳", quote=True)
+    file = f'catalog_{shards}_{message.id}.{kind}.gz'
+
+    async def edit(written):
+        await msg.edit(f"Exported <code>{written}</code> files...")
+
+    try:
+        written = await export_catalog(file, shards, progress=_throttled(edit))
+        await message.reply_document(file, caption=f"<code>{written}</code> files from {shards}. Import it with /import media|media2 as a reply to this file.", quote=True)
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while exporting: {e}")
+    finally:
+        if os.path.exists(file):
+            os.remove(file)
+    await msg.delete()
+
+
+@Client.on_message(filters.command('import') & filters.user(ADMINS))
+async def import_files(bot, message):
+    """Import an export into a db, as a reply to the file: /import media|media2 [restart]"""
+    args = message.command[1:]
+    target = args[0].lower() if args else ''
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if target not in TARGETS or not document:
+        return await message.reply('Reply to an exported file with /import media|media2 [restart]')
+    if not document.file_name.endswith('.gz'):
+        return await message.reply('That is not an export, they end in .bson.gz or .ndjson.gz')
+    msg = await message.reply("Downloading...⏳", quote=True)
+    # the same path every time, so an interrupted import of this file resumes from its checkpoint
+    file = await message.reply_to_message.download(file_name=f'imports/{document.file_unique_id}_{document.file_name}')
+
+    async def edit(read, inserted, duplicates):
+        await msg.edit(f"Read <code>{read}</code> files\nInserted <code>{inserted}</code>\nDuplicates <code>{duplicates}</code>")
+
+    try:
+        read, inserted, duplicates, errors = await import_catalog(file, target, progress=_throttled(edit), restart='restart' in args)
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while importing, run the same command again to resume: {e}")
+    os.remove(file)
+    await msg.edit(
+        f"Import into {target} finished!\n\nRead: <code>{read}</code>\n"
+        f"Inserted: <code>{inserted}</code>\nDuplicates skipped: <code>{duplicates}</code>\nErrors: <code>{errors}</code>"
+    )
+
+
+@Client.on_message(filters.command('backfill') & filters.user(ADMINS))
+async def backfill_files(bot, message):
+    """List backfills, or start one: /backfill [name] [restart]"""
+    args = message.command[1:]
+    if not args:
+        lines = ["<b>Backfills</b>\n"]
+        for name, job in BACKFILLS.items():
+            checkpoint = await get_checkpoint(name)
+            if not checkpoint:
+                state = "not run"
+            else:
+                state = f"{'done' if checkpoint.get('done') else 'running'}, {checkpoint.get('scanned', 0)} scanned, {checkpoint.get('updated', 0)} updated"
+            lines.append(f"<code>{name}</code> ({state})\n{job.description}")
+        lines.append("\nStart one with /backfill name, add restart to run a finished one again.")
+        return await message.reply_text("\n".join(lines), quote=True)
+    name = args[0]
+    if name not in BACKFILLS:
+        return await message.reply(f"No backfill called {name}, send /backfill to list them.")
+    if not start_backfill(name, bot, restart='restart' in args[1:]):
+        return await message.reply(f"Backfill {name} is already running.")
+    await message.reply(f"Backfill <code>{name}</code> started, progress goes to the log channel.", quote=True)
+
+
+@Client.on_message(filters.command('placement') & filters.user(ADMINS))
+async def show_placement(bot, message):
+    """Where the users, groups, connections and filters collections live and how big they are"""
+    msg = await message.reply("Pʀᴏᴄᴇssɪɴɢ...⏳", quote=True)
+    try:
+        clusters, rows = await placement_report()
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while reading db stats: {e}")
+    lines = ["<b>🗂 Collection placement</b>\n"]
+    for cluster, used in clusters.items():
+        lines.append(f"<b>{cluster}:</b> <code>{used:.2f} MB</code> used, <code>{512 - used:.2f} MB</code> free")
+    lines.append("")
+    for name, cluster, count, size in rows:
+        lines.append(f"<code>{name}</code> on {cluster}: <code>{count}</code> docs, <code>{size:.2f} MB</code>")
+    lines.append("\nMove one with /migrate name primary|second")
+    await msg.edit("\n".join(lines))
+
+
+@Client.on_message(filters.command('migrate') & filters.user(ADMINS))
+async def migrate_collection(bot, message):
+    """Move a collection to another cluster: /migrate users|groups|connections|filters primary|second"""
+    args = [arg.lower() for arg in message.command[1:]]
+    if len(args) != 2 or args[0] not in COLLECTIONS or args[1] not in CLUSTERS:
+        return await message.reply(f"Usage: /migrate {'|'.join(COLLECTIONS)} {'|'.join(CLUSTERS)}")
+    name, cluster = args
+    msg = await message.reply(f"Moving {name} to the {cluster} cluster...⏳", quote=True)
+
+    async def edit(copied):
+        await msg.edit(f"Moving {name} to the {cluster} cluster...\nCopied <code>{copied}</code> documents")
+
+    try:
+        copied = await migrate(name, cluster, progress=_throttled(edit))
+        if name in ('users', 'groups'):
+            await db.ensure_indexes()
+        elif name == 'filters':
+            await ensure_filter_indexes()
+    except Exception as e:
+        logger.exception(e)
+        return await msg.edit(f"Error while moving {name}: {e}")
+    await msg.edit(f"<code>{name}</code> is on the {cluster} cluster now, <code>{copied}</code> documents copied.")
@@ -3,7 +3,7 @@ from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from pyrogram.errors.exceptions.bad_request_400 import MessageTooLong, PeerIdInvalid
 from info import ADMINS, LOG_CHANNEL, SUPPORT_CHAT, MELCOW_NEW_USERS
 from database.users_chats_db import db
-from database.ia_filterdb import Media, Media2, db as clientDB, db2 as clientDB2
+from database.stats import stats_text
 from utils import get_size, temp, get_settings
 from Script import script
 from pyrogram.errors import ChatAdminRequired
@@ -14,11 +14,10 @@ from pyrogram.errors import ChatAdminRequired
 async def save_group(bot, message):
     r_j_check = [u.id for u in message.new_chat_members]
     if temp.ME in r_j_check:
-        if not await db.get_chat(message.chat.id):
+        if await db.add_chat(message.chat.id, message.chat.title):
             total=await bot.get_chat_members_count(message.chat.id)
             r_j = message.from_user.mention if message.from_user else "Anonymous" 
             await bot.send_message(LOG_CHANNEL, script.LOG_TEXT_G.format(message.chat.title, message.chat.id, total, r_j))       
-            await db.add_chat(message.chat.id, message.chat.title)
         if message.chat.id in temp.BANNED_CHATS:
             # Inspired from a boat of a banana tree
             buttons = [[
@@ -141,34 +140,7 @@ async def re_enable_chat(bot, message):
 @Client.on_message(filters.command("stats") & filters.incoming)
 async def get_stats(bot, message):
     rju = await message.reply("Fetching stats...")
-    # primary db
-    totalp = await Media.count_documents()
-    # secondary db
-    totalsec = await Media2.count_documents()
-    # users and chats
-    users = await db.total_users_count()
-    chats = await db.total_chat_count()
-    # primary db stats
-    stats = await clientDB.command("dbStats")
-    used_dbSize = (stats["dataSize"] / (1024 * 1024)) + (stats["indexSize"] / (1024 * 1024))
-    free_dbSize = 512 - used_dbSize
-    # secondary db stats
-    stats2 = await clientDB2.command("dbStats")
-    used_dbSize2 = (stats2["dataSize"] / (1024 * 1024)) + (stats2["indexSize"] / (1024 * 1024))
-    free_dbSize2 = 512 - used_dbSize2
-    await rju.edit_text(
-        text=script.STATUS_TXT.format(
-            (int(totalp) + int(totalsec)),  # total combined docs
-            users,                         # total users
-            chats,                         # total chats
-            totalp,                        # primary db docs
-            round(used_dbSize, 2),         # primary used size
-            round(free_dbSize, 2),         # primary free size
-            totalsec,                      # secondary db docs
-            round(used_dbSize2, 2),        # secondary used size
-            round(free_dbSize2, 2)         # secondary free size
-        )
-    )
+    await rju.edit_text(text=await stats_text())
  
 
 # a function for trespassing into others groups, Inspired by a Vazha
@@ -8,13 +8,13 @@ import pyrogram
 from database.connections_mdb import active_connection, all_connections, delete_connection, if_active, make_active, \
     make_inactive
 from info import ADMINS, AUTH_CHANNEL, AUTH_USERS, CUSTOM_FILE_CAPTION, AUTH_GROUPS, P_TTI_SHOW_OFF, IMDB, \
-    SINGLE_BUTTON, SPELL_CHECK_REPLY, IMDB_TEMPLATE, NO_RESULTS_MSG, LOG_CHANNEL
+    SINGLE_BUTTON, SPELL_CHECK_REPLY, IMDB_TEMPLATE, NO_RESULTS_MSG, LOG_CHANNEL, SEARCH_BUDGET_GROUP_MS
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram import Client, filters, enums
 from pyrogram.errors import FloodWait, UserIsBlocked, MessageNotModified, PeerIdInvalid
 from utils import get_size, is_subscribed, get_poster, search_gagala, temp, get_settings, save_group_settings
-from database.users_chats_db import db
-from database.ia_filterdb import Media, Media2, get_file_details, get_search_results, get_bad_files, db as clientDB, db2 as clientDB2
+from database.ia_filterdb import get_file_details, get_search_results, get_bad_files
+from database.stats import stats_text
 from database.filters_mdb import (
     del_all,
     find_filter,
@@ -50,7 +50,7 @@ async def next_page(bot, query):
         await query.answer("You are using one of my old messages, please send the request again.", show_alert=True)
         return
 
-    files, n_offset, total = await get_search_results(query.message.chat.id, search, offset=offset, filter=True)
+    files, n_offset, total = await get_search_results(query.message.chat.id, search, offset=offset, filter=True, budget_ms=SEARCH_BUDGET_GROUP_MS)
     try:
         n_offset = int(n_offset)
     except:
@@ -319,6 +319,8 @@ async def cb_handler(client: Client, query: CallbackQuery):
         ident, file_id = query.data.split("#")
         files_ = await get_file_details(file_id)
         if not files_:
+            if files_.partial:
+                return await query.answer('Database is busy, please try again in a minute.', show_alert=True)
             return await query.answer('No such file exist.')
         files = files_[0]
         title = files.file_name
@@ -374,6 +376,8 @@ async def cb_handler(client: Client, query: CallbackQuery):
                 return await query.answer(f"Eʀʀᴏʀ: {is_over}", show_alert=True)
         files_ = await get_file_details(file_id)
         if not files_:
+            if files_.partial:
+                return await query.answer('Database is busy, please try again in a minute.', show_alert=True)
             return await query.answer('Nᴏ sᴜᴄʜ ғɪʟᴇ ᴇxɪsᴛ.')
         files = files_[0]
         title = files.file_name
@@ -539,23 +543,8 @@ async def cb_handler(client: Client, query: CallbackQuery):
             InlineKeyboardButton('♻️', callback_data='rfrsh')
         ]]
         reply_markup = InlineKeyboardMarkup(buttons)
-        #primary db
-        totalp = await Media.count_documents()
-        #secondary db
-        totalsec = await Media2.count_documents()
-        #users and chats
-        users = await db.total_users_count()
-        chats = await db.total_chat_count()
-        #primary db
-        stats = await clientDB.command('dbStats')
-        used_dbSize = (stats['dataSize']/(1024*1024))+(stats['indexSize']/(1024*1024))
-        free_dbSize = 512-used_dbSize
-        #secondary db
-        stats2 = await clientDB2.command('dbStats')
-        used_dbSize2 = (stats2['dataSize']/(1024*1024))+(stats2['indexSize']/(1024*1024))
-        free_dbSize2 = 512-used_dbSize2
         await query.message.edit_text(
-            text=script.STATUS_TXT.format((int(totalp)+int(totalsec)), users, chats, totalp, round(used_dbSize, 2), round(free_dbSize, 2), totalsec, round(used_dbSize2, 2), round(free_dbSize2, 2)),
+            text=await stats_text(),
             reply_markup=reply_markup,
             parse_mode=enums.ParseMode.HTML
         )
@@ -566,23 +555,8 @@ async def cb_handler(client: Client, query: CallbackQuery):
             InlineKeyboardButton('♻️', callback_data='rfrsh')
         ]]
         reply_markup = InlineKeyboardMarkup(buttons)
-        #primary db
-        totalp = await Media.count_documents()
-        #secondary db
-        totalsec = await Media2.count_documents()
-        #users and chats
-        users = await db.total_users_count()
-        chats = await db.total_chat_count()
-        #primary db
-        stats = await clientDB.command('dbStats')
-        used_dbSize = (stats['dataSize']/(1024*1024))+(stats['indexSize']/(1024*1024))
-        free_dbSize = 512-used_dbSize
-        #secondary db
-        stats2 = await clientDB2.command('dbStats')
-        used_dbSize2 = (stats2['dataSize']/(1024*1024))+(stats2['indexSize']/(1024*1024))
-        free_dbSize2 = 512-used_dbSize2
         await query.message.edit_text(
-            text=script.STATUS_TXT.format((int(totalp)+int(totalsec)), users, chats, totalp, round(used_dbSize, 2), round(free_dbSize, 2), totalsec, round(used_dbSize2, 2), round(free_dbSize2, 2)),
+            text=await stats_text(),
             reply_markup=reply_markup,
             parse_mode=enums.ParseMode.HTML
         )
@@ -663,7 +637,7 @@ async def auto_filter(client, msg, spoll=False):
         # ✅ Run search logic
         if 2 < len(message.text) < 100:
             search = message.text
-            files, offset, total_results = await get_search_results(message.chat.id, search.lower(), offset=0, filter=True)
+            files, offset, total_results = await get_search_results(message.chat.id, search.lower(), offset=0, filter=True, budget_ms=SEARCH_BUDGET_GROUP_MS)
 
             # ✅ If no results, offer Google search
             if not files:
@@ -671,7 +645,7 @@ async def auto_filter(client, msg, spoll=False):
                     InlineKeyboardButton("\n\n🌐 Wanna try Google instead? 👇", url=f"https://www.google.com/search?q={search.replace(' ', '+')}")
                 ]]
                 autodel = await message.reply_text(
-                    f"👋 Hey {message.from_user.mention}, No results found for your query {search}.\n\n🎬 Please enter the movie or series name in the correct search format.\n\n📌 We only provide OTT-released movies. Movies still running in theaters or not yet released on OTT are not available.\n\n🚫 Camera prints are not shared — only HD quality movies are provided.\n<blockquote>⚠️ If you used the correct spelling and the movie has already been released on OTT but you still didn’t get the file, kindly report to admin 👉 @Sandalwood_man</blockquote>",
+                    f"👋 Hey {message.from_user.mention}, No results found for your query {search}.\n\n🎬 Please enter the movie or series name in the correct search format.\n\n📌 We only provide OTT-released movies. Movies still running in theaters or not yet released on OTT are not available.\n\n🚫 Camera prints are not shared — only HD quality movies are provided.\n<blockquote>⚠️ If you used the correct spelling and the movie has already been released on OTT but you still didn’t get the file, kindly report to admin 👉 @Sandalwood_man</blockquote>" + (script.PARTIAL_RESULTS_TXT if getattr(files, 'partial', False) else ''),
                     reply_markup=InlineKeyboardMarkup(btn)
                 )
                 await asyncio.sleep(15)
@@ -739,6 +713,8 @@ async def auto_filter(client, msg, spoll=False):
 
     # ✅ Simple caption (no IMDb)
     cap = f"<b>Hᴇʏ {message.from_user.mention}, Hᴇʀᴇ’ꜱ Wʜᴀᴛ I Fᴏᴜɴᴅ Fᴏʀ Yᴏᴜʀ Qᴜᴇʀʏ:</b> <code>{search}</code>"
+    if getattr(files, 'partial', False):
+        cap += script.PARTIAL_RESULTS_TXT
 
     # ✅ Send response
     try:
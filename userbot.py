@@ -0,0 +1,63 @@
+"""
+Optional user account for indexing. With USERBOT_STRING_SESSION set, index jobs read channel
+history through it (a page of 100 messages per request, media-only searches) instead of the
+bot's id windows. It gets no updates and is never used to talk to users.
+
+The account has to be a member of the channels it indexes, jobs for a channel it can't see
+go through the bot as before.
+"""
+import logging
+from pyrogram import Client
+from info import API_ID, API_HASH, USER_SESSION, USERBOT_STRING_SESSION
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+#the started user client, None when there is none
+client = None
+
+
+async def start_userbot():
+    global client
+    if not USERBOT_STRING_SESSION:
+        return None
+    user = Client(
+        USER_SESSION,
+        api_id=API_ID,
+        api_hash=API_HASH,
+        session_string=USERBOT_STRING_SESSION,
+        in_memory=True,
+        no_updates=True,
+        sleep_threshold=0,  # FloodWaits are raised so the index throttles slow down
+    )
+    try:
+        await user.start()
+    except Exception as e:
+        logger.exception(f"Could not start the indexing user session, indexing through the bot: {e}")
+        return None
+    client = user
+    logger.info(f"Indexing through user session {user.me.first_name} ({user.me.id})")
+    return client
+
+
+async def stop_userbot():
+    global client
+    if client is not None:
+        try:
+            await client.stop()
+        except Exception as e:
+            logger.warning(f"Error stopping the indexing user session: {e}")
+        client = None
+
+
+async def index_client(bot, chat):
+    """(client, Chat) to index `chat` with: the user session when it can see the chat, else the bot."""
+    if client is not None:
+        try:
+            return client, await client.get_chat(chat)
+        except Exception as e:
+            logger.info(f"User session can't access {chat} ({e}), indexing it through the bot")
+    try:
+        return bot, await bot.get_chat(chat)
+    except Exception:
+        return bot, None